@@ -1,42 +1,194 @@
+import os
+import threading
+import time
 from flask import Flask, request, jsonify
 from flask_cors import CORS
-import pandas as pd
-from main import DataWarehouseManager
-import os
 
 app = Flask(__name__)
 CORS(app)
 
-manager = DataWarehouseManager()
+# Services are created on first use so the server answers /health before
+# pandas, the cleaners and the Supabase client have been loaded
+_manager = None
+_chunked_uploads = None
+_services_lock = threading.Lock()
+
+# Readiness is reported separately from liveness once warm-up finishes
+warmup_state = {'status': 'pending', 'error': None, 'missing': [], 'seconds': None, 'attempts': 0}
+_warmup_started = False
+
+# Failed warm-ups are retried with backoff, doubling up to this many seconds
+WARMUP_MAX_BACKOFF = float(os.getenv('WARMUP_MAX_BACKOFF', 60))
+
+def get_manager():
+    """Shared DataWarehouseManager, created on first use"""
+    global _manager
+    if _manager is None:
+        with _services_lock:
+            if _manager is None:
+                from main import DataWarehouseManager
+                _manager = DataWarehouseManager()
+    return _manager
+
+def get_chunked_uploads():
+    """Shared ChunkedUploadManager, created on first use"""
+    global _chunked_uploads
+    if _chunked_uploads is None:
+        with _services_lock:
+            if _chunked_uploads is None:
+                from chunked_upload import ChunkedUploadManager
+                _chunked_uploads = ChunkedUploadManager(
+                    lambda stream, filename, table_name: get_manager().upload_stream(stream, filename, table_name)
+                )
+    return _chunked_uploads
+
+def warm_up():
+    """Load services and preload caches so the first real request is fast
+    
+    A failed attempt (e.g. Supabase unreachable at boot) is retried with
+    backoff until one succeeds, so the worker becomes ready once it can be.
+    """
+    warmup_state['status'] = 'warming_up'
+    start = time.time()
+    delay = 1
+    while True:
+        warmup_state['attempts'] += 1
+        try:
+            get_manager().warm_up()
+            get_chunked_uploads()
+            warmup_state['status'] = 'ready'
+            warmup_state['error'] = None
+            warmup_state['missing'] = []
+            break
+        except Exception as e:
+            print(f"❌ Warm-up failed (attempt {warmup_state['attempts']}), retrying in {delay}s: {e}")
+            # Missing tables or functions are listed until the migration is run
+            missing = getattr(e, 'missing', [])
+            warmup_state['status'] = 'missing_schema' if missing else 'retrying'
+            warmup_state['error'] = str(e)
+            warmup_state['missing'] = missing
+            time.sleep(delay)
+            delay = min(delay * 2, WARMUP_MAX_BACKOFF)
+    warmup_state['seconds'] = round(time.time() - start, 2)
+
+def start_warm_up():
+    global _warmup_started
+    with _services_lock:
+        if _warmup_started:
+            return
+        _warmup_started = True
+    threading.Thread(target=warm_up, daemon=True).start()
+
+def should_warm_up_on_start():
+    """Warm up in the process that serves requests, unless WARMUP_ON_START=false"""
+    if os.getenv('WARMUP_ON_START', 'true').lower() != 'true':
+        return False
+    # app.run(debug=True) serves from a reloader child (WERKZEUG_RUN_MAIN=true);
+    # the parent only watches files and must not warm up a second copy
+    if __name__ == '__main__' and not os.environ.get('WERKZEUG_RUN_MAIN'):
+        return False
+    return True
 
 @app.route('/upload', methods=['POST'])
 def upload_file():
     try:
-        if 'file' not in request.files:
-            return jsonify({'error': 'No file provided'}), 400
+        if request.files:
+            # Multipart upload: one or more files under the 'file' field.
+            # Werkzeug spools each part over 500 KB to a temp file before this
+            # runs, so large files should use the raw body or /upload/init
+            files = request.files.getlist('file')
+            table_name = request.form.get('tableName', 'airlines')
+            
+            if not files:
+                return jsonify({'error': 'No file provided'}), 400
+            if any(file.filename == '' for file in files):
+                return jsonify({'error': 'No file selected'}), 400
+            
+            # Stream each upload straight into the chunked parser
+            results = [get_manager().upload_stream(file.stream, file.filename, table_name) for file in files]
+            result = results[0] if len(results) == 1 else get_manager().combine_results(results)
+        else:
+            # Raw body upload: the request body is the file itself and is
+            # parsed as it arrives, without a temp copy
+            filename = request.args.get('filename') or request.headers.get('X-Filename', '')
+            table_name = request.args.get('tableName', 'auto')
+            
+            if not request.content_length and request.headers.get('Transfer-Encoding') != 'chunked':
+                return jsonify({'error': 'No file provided'}), 400
+            
+            result = get_manager().upload_stream(request.stream, filename, table_name)
         
-        file = request.files['file']
-        table_name = request.form.get('tableName', 'airlines')
+        if 'error' in result:
+            return jsonify(result), 400
         
-        if file.filename == '':
-            return jsonify({'error': 'No file selected'}), 400
+        return jsonify({
+            **result,
+            'message': 'File uploaded successfully'
+        })
+        
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/upload/init', methods=['POST'])
+def init_chunked_upload():
+    try:
+        body = request.get_json(silent=True) or {}
+        
+        if not body.get('filename') or not body.get('totalSize'):
+            return jsonify({'error': 'filename and totalSize are required'}), 400
         
-        # Save uploaded file temporarily
-        file_path = f"temp_{file.filename}"
-        file.save(file_path)
+        upload = get_chunked_uploads().init_upload(
+            filename=body['filename'],
+            total_size=body['totalSize'],
+            table_name=body.get('tableName', 'auto'),
+            chunk_size=body.get('chunkSize')
+        )
+        return jsonify(upload)
         
-        # Process the file
-        manager.upload_file(file_path, table_name)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/upload/<upload_id>/chunk/<int:index>', methods=['PUT'])
+def upload_chunk(upload_id, index):
+    try:
+        return jsonify(get_chunked_uploads().write_chunk(upload_id, index, request.stream))
+    except KeyError as e:
+        return jsonify({'error': str(e)}), 404
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/upload/<upload_id>/status', methods=['GET'])
+def chunked_upload_status(upload_id):
+    try:
+        return jsonify(get_chunked_uploads().status(upload_id))
+    except KeyError as e:
+        return jsonify({'error': str(e)}), 404
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/upload/<upload_id>/finalize', methods=['POST'])
+def finalize_chunked_upload(upload_id):
+    try:
+        result = get_chunked_uploads().finalize(upload_id)
         
-        # Clean up
-        os.remove(file_path)
+        if 'missingChunks' in result and 'error' in result:
+            return jsonify(result), 409
+        if result.get('status') == 'processing':
+            return jsonify(result), 202
+        if 'error' in result:
+            return jsonify(result), 400
         
         return jsonify({
-            'message': 'File uploaded successfully',
-            'table_name': table_name,
-            'processed': 'Data sent to processing queue'
+            **result,
+            'message': 'File uploaded successfully'
         })
         
+    except KeyError as e:
+        return jsonify({'error': str(e)}), 404
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
@@ -58,7 +210,7 @@ def check_eligibility():
         passenger_name = request.args.get('name')
         flight_id = request.args.get('flightID')
         
-        results = manager.check_insurance_eligibility(
+        results = get_manager().check_insurance_eligibility(
             passenger_name=passenger_name,
             flight_id=flight_id
         )
@@ -68,10 +220,41 @@ def check_eligibility():
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
+@app.route('/analytics', methods=['GET'])
+def sales_analytics():
+    try:
+        group_by = request.args.get('groupBy', 'date')
+        
+        results = get_manager().get_sales_analytics(
+            group_by=[dim.strip() for dim in group_by.split(',') if dim.strip()],
+            flight_key=request.args.get('flightID'),
+            airline_key=request.args.get('airline'),
+            origin=request.args.get('origin'),
+            destination=request.args.get('destination'),
+            date_from=request.args.get('dateFrom'),
+            date_to=request.args.get('dateTo')
+        )
+        
+        return jsonify(results)
+        
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
 @app.route('/health', methods=['GET'])
 def health_check():
     return jsonify({'status': 'healthy'})
 
+@app.route('/ready', methods=['GET'])
+def readiness_check():
+    status_code = 200 if warmup_state['status'] == 'ready' else 503
+    return jsonify(warmup_state), status_code
+
+# Warm up in the background as soon as the worker starts
+if should_warm_up_on_start():
+    start_warm_up()
+
 if __name__ == '__main__':
     app.run(debug=True, port=5000)
     
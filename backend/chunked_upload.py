@@ -0,0 +1,425 @@
+import io
+import json
+import os
+import shutil
+import socket
+import threading
+import time
+import uuid
+
+# Where in-progress uploads keep their chunks
+UPLOAD_DIR = os.getenv('UPLOAD_DIR', 'uploads')
+
+# Default and maximum size of a single chunk (bytes)
+DEFAULT_CHUNK_SIZE = 8 * 1024 * 1024
+MAX_CHUNK_SIZE = 64 * 1024 * 1024
+
+# Abandoned uploads stop waiting for chunks, and are deleted, after this many idle seconds
+UPLOAD_IDLE_TIMEOUT = float(os.getenv('UPLOAD_IDLE_TIMEOUT', 24 * 60 * 60))
+
+# Seconds between checks for chunks written by other worker processes
+CHUNK_POLL_INTERVAL = 1
+
+# The ingesting process refreshes its claim this often; a claim not refreshed
+# for CLAIM_TTL seconds is taken over by the next process that sees the upload
+CLAIM_HEARTBEAT = 10
+CLAIM_TTL = 60
+
+
+class _PrefixChunkStream(io.RawIOBase):
+    """Read an upload's chunks in order, blocking until the next chunk arrives"""
+
+    def __init__(self, upload):
+        self.upload = upload
+        self.index = 0
+        self.current = None
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        while True:
+            if self.current is None:
+                path = self.upload.wait_for_chunk(self.index)
+                if path is None:
+                    return 0  # Every chunk has been read
+                self.current = open(path, 'rb')
+
+            size = self.current.readinto(buffer)
+            if size:
+                self.upload.bytes_ingested += size
+                return size
+
+            self.current.close()
+            self.current = None
+            self.index += 1
+
+    def close(self):
+        if self.current is not None:
+            self.current.close()
+            self.current = None
+        super().close()
+
+
+class ChunkedUpload:
+    """State of one resumable upload
+
+    Chunks, the claim of the process ingesting the upload and the final
+    result all live in the upload's directory, so every worker process
+    sees the same state.
+    """
+
+    def __init__(self, upload_id, meta, directory):
+        self.upload_id = upload_id
+        self.meta = meta
+        self.directory = directory
+        self.condition = threading.Condition()
+        self.cancelled = False
+        self.owned = False
+        self.bytes_ingested = 0
+        self.ingest_thread = None
+
+    @property
+    def total_chunks(self):
+        return self.meta['totalChunks']
+
+    @property
+    def meta_path(self):
+        return os.path.join(self.directory, 'meta.json')
+
+    @property
+    def claim_path(self):
+        return os.path.join(self.directory, 'claim.json')
+
+    @property
+    def result_path(self):
+        return os.path.join(self.directory, 'result.json')
+
+    def chunk_path(self, index):
+        return os.path.join(self.directory, f'{index:06d}.part')
+
+    def missing_chunks(self):
+        """Indexes of chunks the client still has to send"""
+        return [i for i in range(self.total_chunks) if not os.path.exists(self.chunk_path(i))]
+
+    def expected_chunk_size(self, index):
+        """Size a chunk must have to be accepted"""
+        if index < self.total_chunks - 1:
+            return self.meta['chunkSize']
+        return self.meta['totalSize'] - self.meta['chunkSize'] * (self.total_chunks - 1)
+
+    def last_chunk_activity(self):
+        """Time the newest chunk, or the upload itself, was written"""
+        latest = 0.0
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith('.part') or entry.name == 'meta.json':
+                latest = max(latest, entry.stat().st_mtime)
+        return latest
+
+    def wait_for_chunk(self, index):
+        """Block until a chunk is on disk; None once the stream has no more chunks"""
+        with self.condition:
+            while True:
+                if self.cancelled:
+                    raise RuntimeError(f'Upload {self.upload_id} was cancelled')
+                if index >= self.total_chunks:
+                    return None
+                path = self.chunk_path(index)
+                if os.path.exists(path):
+                    return path
+                if not os.path.isdir(self.directory):
+                    raise RuntimeError(f'Upload {self.upload_id} was removed')
+                if time.time() - self.last_chunk_activity() > UPLOAD_IDLE_TIMEOUT:
+                    raise TimeoutError(f'Upload {self.upload_id} timed out waiting for chunk {index}')
+                # Chunks written by other worker processes are picked up by polling
+                self.condition.wait(timeout=CHUNK_POLL_INTERVAL)
+
+    def notify(self):
+        with self.condition:
+            self.condition.notify_all()
+
+    def cancel(self):
+        with self.condition:
+            self.cancelled = True
+            self.condition.notify_all()
+
+    def read_json(self, path):
+        try:
+            with open(path) as f:
+                return json.load(f)
+        except (FileNotFoundError, ValueError):
+            return None
+
+    def write_json(self, path, data):
+        """Replace a JSON file atomically"""
+        tmp_path = f'{path}.{uuid.uuid4().hex}.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(data, f, default=str)
+        os.replace(tmp_path, path)
+
+    def result(self):
+        """Ingest result once the owning process has finished, else None"""
+        return self.read_json(self.result_path)
+
+    def ingested_bytes(self):
+        """Bytes consumed so far, as last reported by the owning process"""
+        if self.owned:
+            return self.bytes_ingested
+        claim = self.read_json(self.claim_path) or {}
+        return claim.get('bytesIngested', 0)
+
+
+class ChunkedUploadManager:
+    """Resumable upload protocol: init, upload numbered chunks, query missing, finalize
+
+    Chunks are written to disk as they arrive and the contiguous prefix is fed
+    to the ingest pipeline straight away, so parsing overlaps the upload.
+    Chunks may arrive at any worker process; exactly one process holds the
+    upload's claim file and runs its ingest.
+    """
+
+    def __init__(self, ingest, upload_dir=UPLOAD_DIR):
+        # ingest(stream, filename, table_name) -> result dict
+        self.ingest = ingest
+        self.upload_dir = upload_dir
+        self.uploads = {}
+        self.lock = threading.Lock()
+        self.owner = f'{socket.gethostname()}:{os.getpid()}'
+        os.makedirs(self.upload_dir, exist_ok=True)
+        self.cleanup_expired()
+
+    def init_upload(self, filename, total_size, table_name='auto', chunk_size=DEFAULT_CHUNK_SIZE):
+        """Start a new upload and return its id and chunk layout"""
+        total_size = int(total_size)
+        chunk_size = int(chunk_size or DEFAULT_CHUNK_SIZE)
+
+        if total_size <= 0:
+            raise ValueError('totalSize must be positive')
+        if chunk_size <= 0 or chunk_size > MAX_CHUNK_SIZE:
+            raise ValueError(f'chunkSize must be between 1 and {MAX_CHUNK_SIZE} bytes')
+
+        self.cleanup_expired()
+
+        upload_id = uuid.uuid4().hex
+        meta = {
+            'uploadId': upload_id,
+            'filename': os.path.basename(filename or ''),
+            'tableName': table_name or 'auto',
+            'totalSize': total_size,
+            'chunkSize': chunk_size,
+            'totalChunks': (total_size + chunk_size - 1) // chunk_size
+        }
+
+        directory = os.path.join(self.upload_dir, upload_id)
+        os.makedirs(directory, exist_ok=True)
+        upload = ChunkedUpload(upload_id, meta, directory)
+        upload.write_json(upload.meta_path, meta)
+
+        with self.lock:
+            self.uploads[upload_id] = upload
+        self.claim_and_ingest(upload)
+
+        print(f"📤 Started upload {upload_id}: {meta['filename']} in {meta['totalChunks']} chunks")
+        return meta
+
+    def get_upload(self, upload_id):
+        """Find an upload, loading it from disk if another process (or a restart) created it"""
+        # Only accept ids we could have generated
+        if not upload_id or not all(c in '0123456789abcdef' for c in upload_id):
+            return None
+
+        directory = os.path.join(self.upload_dir, upload_id)
+        meta_path = os.path.join(directory, 'meta.json')
+        with self.lock:
+            upload = self.uploads.get(upload_id)
+            if not os.path.exists(meta_path):
+                # Finalized or cleaned up, possibly by another process
+                if upload is not None:
+                    self.uploads.pop(upload_id, None)
+                    upload.cancel()
+                return None
+
+            if upload is None:
+                with open(meta_path) as f:
+                    meta = json.load(f)
+                upload = ChunkedUpload(upload_id, meta, directory)
+                self.uploads[upload_id] = upload
+
+        # Take over the ingest if its owner stopped (restart or crashed worker)
+        if not upload.owned:
+            self.claim_and_ingest(upload)
+        return upload
+
+    def claim(self, upload):
+        """Make this process the upload's only ingester, unless a live owner exists"""
+        if os.path.exists(upload.result_path):
+            return False
+
+        try:
+            claimed_at = os.path.getmtime(upload.claim_path)
+        except FileNotFoundError:
+            claimed_at = None
+
+        if claimed_at is not None:
+            if time.time() - claimed_at < CLAIM_TTL:
+                return False
+            # The owner stopped refreshing its claim; only one process can move it aside
+            stale_path = f'{upload.claim_path}.{uuid.uuid4().hex}.stale'
+            try:
+                os.rename(upload.claim_path, stale_path)
+            except FileNotFoundError:
+                return False
+            if time.time() - os.path.getmtime(stale_path) < CLAIM_TTL:
+                # Moved a claim refreshed in the meantime: put it back
+                os.rename(stale_path, upload.claim_path)
+                return False
+            os.remove(stale_path)
+
+        try:
+            fd = os.open(upload.claim_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            return False
+        with os.fdopen(fd, 'w') as f:
+            json.dump({'owner': self.owner, 'bytesIngested': 0}, f)
+
+        # The previous owner writes result.json before dropping its claim, so
+        # it may have finished between the first check and the create
+        if os.path.exists(upload.result_path):
+            try:
+                os.remove(upload.claim_path)
+            except FileNotFoundError:
+                pass
+            return False
+        return True
+
+    def claim_and_ingest(self, upload):
+        """Start ingesting the upload here if this process wins its claim"""
+        with upload.condition:
+            if upload.owned or not self.claim(upload):
+                return
+            upload.owned = True
+        self.start_ingest(upload)
+
+    def start_ingest(self, upload):
+        """Consume the upload's chunks in a background thread as they arrive"""
+        def run():
+            stream = io.BufferedReader(_PrefixChunkStream(upload))
+            try:
+                result = self.ingest(stream, upload.meta['filename'], upload.meta['tableName'])
+            except Exception as e:
+                result = {'error': str(e)}
+            finally:
+                stream.close()
+
+            if os.path.isdir(upload.directory):
+                upload.write_json(upload.result_path, result)
+            try:
+                os.remove(upload.claim_path)
+            except FileNotFoundError:
+                pass
+
+        def heartbeat():
+            # Keep the claim fresh, and publish progress to the other workers
+            while upload.ingest_thread.is_alive():
+                upload.ingest_thread.join(CLAIM_HEARTBEAT)
+                if upload.ingest_thread.is_alive() and os.path.isdir(upload.directory):
+                    upload.write_json(upload.claim_path, {
+                        'owner': self.owner,
+                        'bytesIngested': upload.bytes_ingested
+                    })
+
+        upload.ingest_thread = threading.Thread(target=run, daemon=True)
+        upload.ingest_thread.start()
+        threading.Thread(target=heartbeat, daemon=True).start()
+
+    def write_chunk(self, upload_id, index, stream):
+        """Store one chunk; re-sending a chunk simply overwrites it"""
+        upload = self.get_upload(upload_id)
+        if upload is None:
+            raise KeyError(f'Unknown upload: {upload_id}')
+
+        index = int(index)
+        if index < 0 or index >= upload.total_chunks:
+            raise ValueError(f'Chunk index out of range: {index}')
+
+        # Write to a temp name and rename so readers never see a partial chunk
+        path = upload.chunk_path(index)
+        tmp_path = f'{path}.{uuid.uuid4().hex}.tmp'
+        size = 0
+        with open(tmp_path, 'wb') as f:
+            while True:
+                block = stream.read(1024 * 1024)
+                if not block:
+                    break
+                size += len(block)
+                f.write(block)
+
+        expected = upload.expected_chunk_size(index)
+        if size != expected:
+            os.remove(tmp_path)
+            raise ValueError(f'Chunk {index} has {size} bytes, expected {expected}')
+
+        os.replace(tmp_path, path)
+        upload.notify()
+        return self.status(upload_id)
+
+    def status(self, upload_id):
+        """Report received and missing chunks plus ingest progress"""
+        upload = self.get_upload(upload_id)
+        if upload is None:
+            raise KeyError(f'Unknown upload: {upload_id}')
+
+        missing = upload.missing_chunks()
+        return {
+            'uploadId': upload_id,
+            'totalChunks': upload.total_chunks,
+            'receivedChunks': upload.total_chunks - len(missing),
+            'missingChunks': missing,
+            'bytesIngested': upload.ingested_bytes(),
+            'totalSize': upload.meta['totalSize'],
+            'complete': os.path.exists(upload.result_path)
+        }
+
+    def finalize(self, upload_id):
+        """Return the ingest result once it is ready, without waiting for it
+
+        While the ingest is still running this reports {'status': 'processing'}
+        and the client polls status until it is complete.
+        """
+        upload = self.get_upload(upload_id)
+        if upload is None:
+            raise KeyError(f'Unknown upload: {upload_id}')
+
+        missing = upload.missing_chunks()
+        if missing:
+            return {'error': 'Upload incomplete', 'missingChunks': missing}
+
+        result = upload.result()
+        if result is None:
+            return {'status': 'processing', **self.status(upload_id)}
+
+        self.discard(upload_id)
+        return result
+
+    def discard(self, upload_id):
+        """Cancel an upload and delete its chunks"""
+        with self.lock:
+            upload = self.uploads.pop(upload_id, None)
+        if upload is not None:
+            upload.cancel()
+        shutil.rmtree(os.path.join(self.upload_dir, upload_id), ignore_errors=True)
+
+    def cleanup_expired(self):
+        """Delete uploads (and unfetched results) untouched for UPLOAD_IDLE_TIMEOUT"""
+        now = time.time()
+        for upload_id in os.listdir(self.upload_dir):
+            directory = os.path.join(self.upload_dir, upload_id)
+            try:
+                # Chunks, the owner's heartbeat and the result all count as activity
+                entries = list(os.scandir(directory))
+                latest = max([entry.stat().st_mtime for entry in entries] + [os.path.getmtime(directory)])
+            except (FileNotFoundError, NotADirectoryError):
+                continue
+            if now - latest > UPLOAD_IDLE_TIMEOUT:
+                print(f"🧹 Removing expired upload {upload_id}")
+                self.discard(upload_id)
@@ -2,12 +2,53 @@ import pandas as pd
 import re
 import json
 from datetime import datetime
+from id_allocator import IdAllocator, IdLeaseError
+from passenger_resolver import PassengerResolver
+
+# Alternative names accepted for a table type
+TABLE_ALIASES = {'sales': 'travel_agency_sales_001'}
+
+# Warehouse table each source table type is loaded into
+TARGET_TABLES = {
+    'airlines': 'airlines',
+    'airports': 'airports',
+    'flights': 'flights',
+    'passengers': 'passengers',
+    'travel_agency_sales_001': 'factairlinesales'
+}
+
+# Date layouts recognised in source files: (regex capturing the date part, format).
+# Day/month order of the NN/NN/YYYY layouts is decided once per file in resolve_date_order
+DATE_FORMATS = [
+    (r'^(\d{4}-\d{1,2}-\d{1,2})(?:[T\s].*)?$', '%Y-%m-%d'),
+    (r'^(\d{4}/\d{1,2}/\d{1,2})(?:[T\s].*)?$', '%Y/%m/%d'),
+    (r'^(\d{8})$', '%Y%m%d'),
+    (r'^(\d{1,2}/\d{1,2}/\d{4})(?:\s.*)?$', '%m/%d/%Y'),
+    (r'^(\d{1,2}-\d{1,2}-\d{4})(?:\s.*)?$', '%m-%d-%Y'),
+    (r'^(\d{1,2}\.\d{1,2}\.\d{4})(?:\s.*)?$', '%d.%m.%Y'),
+    (r'^([A-Za-z]{3,9}\.?\s+\d{1,2},?\s+\d{4})$', '%B %d %Y'),
+    (r'^(\d{1,2}\s+[A-Za-z]{3,9}\.?,?\s+\d{4})$', '%d %B %Y')
+]
+
+# Parsed dates outside these years are treated as unparseable
+DATE_YEAR_RANGE = (1900, 2100)
+
+class InsertError(Exception):
+    """An insert failure that is not caused by the row, raised part-way through a batch"""
+    
+    def __init__(self, error, handled, inserted_records, duplicate_errors):
+        super().__init__(str(error))
+        self.handled = handled  # Records before the failing one, inserted or moved to dirty data
+        self.inserted_records = inserted_records
+        self.duplicate_errors = duplicate_errors
 
 class DataCleaner:
     def __init__(self, supabase_client):
         self.supabase = supabase_client
-        self.current_passenger_id = 1000
-        self.current_transaction_id = 40000
+        # Generated keys come from blocks leased off a shared sequence, so
+        # parallel workers never mint the same id
+        self.id_allocator = IdAllocator(supabase_client)
+        self.passenger_resolver = PassengerResolver(supabase_client)
         
         # Column mapping from CSV headers to database column names
         self.column_mappings = {
@@ -58,6 +99,15 @@ class DataCleaner:
         valid_columns = [col for col in df_renamed.columns if col in mapping.values()]
         return df_renamed[valid_columns]
     
+    def get_source_columns(self, table_name, columns):
+        """Pick the file columns the table's mapping uses, for column projection"""
+        if table_name not in self.column_mappings:
+            return list(columns)
+            
+        mapping = self.column_mappings[table_name]
+        wanted = set(mapping.keys()) | set(mapping.values())
+        return [col for col in columns if col in wanted]
+    
     def get_existing_keys(self, table_name, key_column):
         """Get existing keys from database to check for duplicates"""
         try:
@@ -67,35 +117,76 @@ class DataCleaner:
             print(f"Error getting existing keys from {table_name}: {e}")
             return set()
     
-    def insert_data_with_duplicate_handling(self, table_name, cleaned_data):
-        """Insert data while handling duplicates by moving them to dirty table"""
-        successful_inserts = 0
+    def insert_data_with_duplicate_handling(self, table_name, cleaned_data, raise_errors=False):
+        """Insert data while handling duplicates by moving them to dirty table
+        
+        With raise_errors, failures that are not about the row itself (timeouts,
+        Supabase unavailable) stop the batch with an InsertError so the caller
+        can retry; rows handled before it are reported on the exception.
+        """
+        inserted_records = []
         duplicate_errors = []
         
-        for record in cleaned_data:
-            try:
-                # Try to insert each record individually
-                response = self.supabase.table(table_name).insert(record).execute()
-                if response.data:
-                    successful_inserts += 1
-            except Exception as e:
-                error_str = str(e)
-                # Check if it's a duplicate key error
-                if '23505' in error_str or 'duplicate' in error_str.lower():
-                    duplicate_errors.append({
-                        'table_name': table_name,
-                        'original_data': record,
-                        'error_reason': f'Duplicate key: {error_str}'
-                    })
-                else:
-                    # Other errors also go to dirty data
-                    duplicate_errors.append({
-                        'table_name': table_name,
-                        'original_data': record,
-                        'error_reason': error_str
-                    })
-        
-        return successful_inserts, duplicate_errors
+        for position, record in enumerate(cleaned_data):
+            status, error = self.insert_record(table_name, record)
+            if status == 'inserted':
+                inserted_records.append(record)
+            elif status == 'retry' and raise_errors:
+                raise InsertError(error, position, inserted_records, duplicate_errors) from error
+            elif error is not None:
+                duplicate_errors.append(self.insert_error_record(table_name, record, error))
+        
+        return inserted_records, duplicate_errors
+    
+    def insert_record(self, table_name, record):
+        """Insert one row; returns (status, error)
+        
+        status is 'inserted', 'dirty' for duplicates and data or constraint
+        errors (SQLSTATE 22xxx/23xxx), or 'retry' for failures that are not
+        about the row itself (timeouts, Supabase unavailable).
+        """
+        try:
+            response = self.supabase.table(table_name).insert(record).execute()
+            return ('inserted' if response.data else 'dirty'), None
+        except Exception as e:
+            code = self.error_code(e)
+            if code == '23505' or 'duplicate' in str(e).lower() or self.is_row_error(code):
+                return 'dirty', e
+            return 'retry', e
+    
+    def insert_error_record(self, table_name, record, error):
+        """Describe a row its insert rejected"""
+        error_str = str(error)
+        # Check if it's a duplicate key error
+        if self.error_code(error) == '23505' or 'duplicate' in error_str.lower():
+            error_str = f'Duplicate key: {error_str}'
+        return {
+            'table_name': table_name,
+            'original_data': record,
+            'error_reason': error_str
+        }
+    
+    def error_code(self, error):
+        """Postgres SQLSTATE or PostgREST code of an insert error, if it carries one"""
+        code = getattr(error, 'code', None)
+        if code:
+            return str(code)
+        match = re.search(r"""['"]code['"]:\s*['"]([0-9A-Z]{5}|PGRST\d+)['"]""", str(error))
+        return match.group(1) if match else None
+    
+    def is_row_error(self, code):
+        """True for data and constraint errors (SQLSTATE 22xxx/23xxx) that retrying will not fix"""
+        return bool(code) and code[:2] in ('22', '23')
+    
+    def dirty_record(self, table_name, row, error):
+        """Describe a row that failed cleaning"""
+        # The raw row stays a Series; the dirty-data sink only converts it
+        # to a dict if the row is actually stored
+        return {
+            'table_name': table_name,
+            'original_data': row,
+            'error_reason': str(error)
+        }
     
     def clean_airline_key(self, airline_key):
         """Clean airline key to 2 uppercase letters"""
@@ -150,38 +241,41 @@ class DataCleaner:
     
     def clean_passenger_key(self, passenger_key, existing_keys=None):
         """Clean passenger key to P + incrementing number starting from 1001"""
+        num = self.source_passenger_number(passenger_key)
+        if num is None:
+            return f"P{self.id_allocator.next_id('passenger')}"
+        return f"P{num}"
+    
+    def source_passenger_number(self, passenger_key):
+        """Number of a source passenger key that is kept as-is, else None"""
         if pd.isna(passenger_key):
-            self.current_passenger_id += 1
-            return f"P{self.current_passenger_id}"
+            return None
             
         # Check if it's already in correct format
         if re.match(r'^P\d{4,}$', str(passenger_key)):
             # Extract the number and ensure proper formatting
-            num = int(re.findall(r'\d+', passenger_key)[0])
-            return f"P{num}"
+            return int(re.findall(r'\d+', passenger_key)[0])
             
-        # Extract numbers and create new ID
+        # Use the first number found, but only if it is at least 1000
         numbers = re.findall(r'\d+', str(passenger_key))
-        if numbers:
-            # Use the first number found, but ensure it's at least 1001
-            num = int(numbers[0])
-            if num < 1000:
-                self.current_passenger_id += 1
-                return f"P{self.current_passenger_id}"
-            else:
-                return f"P{num}"
-        else:
-            self.current_passenger_id += 1
-            return f"P{self.current_passenger_id}"
+        if numbers and int(numbers[0]) >= 1000:
+            return int(numbers[0])
+        return None
     
     def clean_transaction_id(self, transaction_id, existing_ids=None):
         """Clean transaction ID starting from 40001"""
+        num = self.source_transaction_number(transaction_id)
+        if num is None:
+            return self.id_allocator.next_id('transaction')
+        return num
+    
+    def source_transaction_number(self, transaction_id):
+        """Source transaction ID that is kept as-is, else None"""
         if pd.isna(transaction_id):
-            self.current_transaction_id += 1
-            return self.current_transaction_id
+            return None
             
         # If it's already a valid number
-        if isinstance(transaction_id, (int, float)) and not pd.isna(transaction_id):
+        if isinstance(transaction_id, (int, float)):
             num = int(transaction_id)
             if num >= 40000:
                 return num
@@ -192,12 +286,17 @@ class DataCleaner:
             num = int(''.join(numbers))
             if num >= 40000:
                 return num
-            else:
-                self.current_transaction_id += 1
-                return self.current_transaction_id
-        else:
-            self.current_transaction_id += 1
-            return self.current_transaction_id
+        return None
+    
+    def skip_past_source_ids(self, df_mapped):
+        """Lease generated ids above every source key in the batch that is loaded unchanged"""
+        columns = {'passengerkey': ('passenger', self.source_passenger_number),
+                   'transactionid': ('transaction', self.source_transaction_number)}
+        for column, (sequence, source_number) in columns.items():
+            if column in df_mapped:
+                numbers = df_mapped[column].map(source_number).dropna()
+                if not numbers.empty:
+                    self.id_allocator.skip_past(sequence, int(numbers.max()))
     
     def clean_email(self, email, full_name):
         """Standardize email to firstname.lastname@example.com"""
@@ -242,26 +341,77 @@ class DataCleaner:
         return country_mapping.get(country, country)
     
     def clean_date(self, date_value):
-        """Clean and standardize date format"""
-        if pd.isna(date_value):
-            return None
+        """Clean and standardize a single date to a YYYYMMDD datekey"""
+        date_key = self.parse_dates(pd.Series([date_value], dtype=object)).iloc[0]
+        return None if pd.isna(date_key) else int(date_key)
+    
+    def parse_dates(self, values, date_orders=None):
+        """Parse a column of dates into YYYYMMDD datekeys (<NA> where unparseable)
+        
+        Values are grouped by the layout they match and each group is parsed
+        with a single vectorized call. Values matching no layout, invalid
+        calendar dates and years outside DATE_YEAR_RANGE stay <NA>.
+        date_orders carries the day/month order chosen for each ambiguous
+        layout across the chunks of one file.
+        """
+        if pd.api.types.is_datetime64_any_dtype(values):
+            return self.date_keys(self.plausible_dates(values.dropna())).reindex(values.index)
+        
+        if date_orders is None:
+            date_orders = {}
+        
+        date_keys = pd.Series(pd.NA, index=values.index, dtype='Int64')
+        text = values.astype('string').str.strip().str.replace(r'\.0$', '', regex=True)
+        remaining = text.notna() & (text != '')
+        
+        for pattern, date_format in DATE_FORMATS:
+            if not remaining.any():
+                break
+            matched = text[remaining].str.extract(pattern, expand=False).dropna()
+            if matched.empty:
+                continue
+            # Matched but invalid (e.g. 2024-02-30) stays unparsed
+            remaining.loc[matched.index] = False
             
-        try:
-            # Try different date formats
-            if isinstance(date_value, str):
-                # Remove any time component
-                date_value = date_value.split()[0]
-                
-            # Parse the date
-            if '/' in str(date_value):
-                return pd.to_datetime(date_value, format='%Y/%m/%d').strftime('%Y%m%d')
-            elif '-' in str(date_value):
-                return pd.to_datetime(date_value, format='%Y-%m-%d').strftime('%Y%m%d')
+            if '%B' in date_format:
+                # "Jan. 5, 2024" -> "Jan 5 2024"; full and abbreviated month names
+                matched = matched.str.replace(r'[.,]', '', regex=True).str.split().str.join(' ')
+                parsed = pd.to_datetime(matched, format=date_format, errors='coerce')
+                abbreviated = pd.to_datetime(matched, format=date_format.replace('%B', '%b'), errors='coerce')
+                parsed = parsed.fillna(abbreviated)
             else:
-                # Assume it's already in YYYYMMDD format
-                return int(date_value)
-        except:
-            return None
+                date_format = self.resolve_date_order(matched, date_format, date_orders)
+                parsed = pd.to_datetime(matched, format=date_format, errors='coerce')
+            
+            parsed = self.plausible_dates(parsed.dropna())
+            date_keys.loc[parsed.index] = self.date_keys(parsed)
+        
+        return date_keys
+    
+    def resolve_date_order(self, matched, date_format, date_orders):
+        """Day/month order for a month-first layout, fixed by the first chunk of a file that uses it
+        
+        The order is day-first if that chunk has a first part above 12,
+        month-first otherwise. Later values that contradict it fail to parse
+        and are reported as dirty rather than reinterpreted.
+        """
+        if not date_format.startswith('%m'):
+            return date_format
+        if date_format not in date_orders:
+            first_part = matched.str.extract(r'^(\d{1,2})', expand=False).astype(int)
+            if (first_part > 12).any():
+                date_orders[date_format] = date_format.replace('%m', '%_').replace('%d', '%m').replace('%_', '%d')
+            else:
+                date_orders[date_format] = date_format
+        return date_orders[date_format]
+    
+    def plausible_dates(self, dates):
+        """Drop parsed dates with a year outside DATE_YEAR_RANGE"""
+        return dates[dates.dt.year.between(*DATE_YEAR_RANGE)]
+    
+    def date_keys(self, dates):
+        """YYYYMMDD integer keys for a series of parsed dates"""
+        return (dates.dt.year * 10000 + dates.dt.month * 100 + dates.dt.day).astype('Int64')
     
     def clean_amount(self, amount):
         """Clean monetary amounts"""
@@ -278,6 +428,7 @@ class DataCleaner:
     def process_airlines_data(self, df):
         """Process and clean airlines data"""
         cleaned_data = []
+        source_index = []  # df index of each cleaned row
         dirty_data = []
         
         # Map column names first
@@ -286,7 +437,7 @@ class DataCleaner:
         # Get existing airline keys to identify duplicates during cleaning
         existing_airlines = self.get_existing_keys('airlines', 'airlinekey')
         
-        for _, row in df_mapped.iterrows():
+        for index, row in df_mapped.iterrows():
             try:
                 airline_key = self.clean_airline_key(row.get('airlinekey'))
                 
@@ -304,25 +455,23 @@ class DataCleaner:
                     raise ValueError("Missing AirlineName")
                     
                 cleaned_data.append(cleaned_row)
+                source_index.append(index)
                 
             except Exception as e:
-                dirty_data.append({
-                    'table_name': 'airlines',
-                    'original_data': row.to_dict(),
-                    'error_reason': str(e)
-                })
+                dirty_data.append(self.dirty_record('airlines', row, e))
         
-        return pd.DataFrame(cleaned_data), dirty_data
+        return pd.DataFrame(cleaned_data, index=source_index), dirty_data
     
     def process_airports_data(self, df):
         """Process and clean airports data"""
         cleaned_data = []
+        source_index = []  # df index of each cleaned row
         dirty_data = []
         
         # Map column names first
         df_mapped = self.map_columns(df, 'airports')
         
-        for _, row in df_mapped.iterrows():
+        for index, row in df_mapped.iterrows():
             try:
                 airport_key = self.clean_airport_key(row.get('airportkey'))
                 
@@ -341,25 +490,27 @@ class DataCleaner:
                     raise ValueError("Missing required fields")
                     
                 cleaned_data.append(cleaned_row)
+                source_index.append(index)
                 
             except Exception as e:
-                dirty_data.append({
-                    'table_name': 'airports',
-                    'original_data': row.to_dict(),
-                    'error_reason': str(e)
-                })
+                dirty_data.append(self.dirty_record('airports', row, e))
         
-        return pd.DataFrame(cleaned_data), dirty_data
+        return pd.DataFrame(cleaned_data, index=source_index), dirty_data
     
     def process_passengers_data(self, df):
         """Process and clean passengers data"""
         cleaned_data = []
+        source_index = []  # df index of each cleaned row
+        source_rows = []
         dirty_data = []
         
         # Map column names first
         df_mapped = self.map_columns(df, 'passengers')
         
-        for _, row in df_mapped.iterrows():
+        # Generated keys must not collide with the keys this batch keeps as-is
+        self.skip_past_source_ids(df_mapped)
+        
+        for index, row in df_mapped.iterrows():
             try:
                 passenger_key = self.clean_passenger_key(row.get('passengerkey'))
                 
@@ -375,25 +526,44 @@ class DataCleaner:
                 }
                 
                 cleaned_data.append(cleaned_row)
+                source_index.append(index)
+                source_rows.append(row)
                 
+            except IdLeaseError:
+                # Not the row's fault: fail the batch so it is retried, not recorded as dirty
+                raise
             except Exception as e:
-                dirty_data.append({
-                    'table_name': 'passengers',
-                    'original_data': row.to_dict(),
-                    'error_reason': str(e)
-                })
+                dirty_data.append(self.dirty_record('passengers', row, e))
+        
+        # Merge records describing the same person under one passengerkey
+        canonical, merges, collisions = self.passenger_resolver.resolve(cleaned_data)
+        for collision in collisions:
+            dirty_data.append(self.dirty_record(
+                'passengers', source_rows[collision['position']],
+                f"Passenger key collision: {collision['passengerkey']} already belongs to {collision['existing_name']}"
+            ))
+        if merges:
+            print(f"🔗 Merged {len(merges)} duplicate passengers")
+            self.passenger_resolver.store_merges(merges)
+            for merge in merges:
+                dirty_data.append(self.dirty_record(
+                    'passengers', source_rows[merge['position']],
+                    f"Duplicate passenger: merged into {merge['canonical_passengerkey']} (score {merge['score']})"
+                ))
         
-        return pd.DataFrame(cleaned_data), dirty_data
+        return pd.DataFrame([cleaned_data[position] for position in canonical],
+                            index=[source_index[position] for position in canonical]), dirty_data
     
     def process_flights_data(self, df):
         """Process and clean flights data"""
         cleaned_data = []
+        source_index = []  # df index of each cleaned row
         dirty_data = []
         
         # Map column names first
         df_mapped = self.map_columns(df, 'flights')
         
-        for _, row in df_mapped.iterrows():
+        for index, row in df_mapped.iterrows():
             try:
                 flight_key = self.clean_flight_key(row.get('flightkey'))
                 
@@ -412,36 +582,48 @@ class DataCleaner:
                     raise ValueError("Missing airport codes")
                     
                 cleaned_data.append(cleaned_row)
+                source_index.append(index)
                 
             except Exception as e:
-                dirty_data.append({
-                    'table_name': 'flights',
-                    'original_data': row.to_dict(),
-                    'error_reason': str(e)
-                })
+                dirty_data.append(self.dirty_record('flights', row, e))
         
-        return pd.DataFrame(cleaned_data), dirty_data
+        return pd.DataFrame(cleaned_data, index=source_index), dirty_data
     
-    def process_sales_data(self, df):
+    def process_sales_data(self, df, date_orders=None):
         """Process and clean sales data"""
         cleaned_data = []
+        source_index = []  # df index of each cleaned row
         dirty_data = []
         
         # Map column names first - note the CSV is travel_agency_sales_001
         df_mapped = self.map_columns(df, 'travel_agency_sales_001')
         
-        for _, row in df_mapped.iterrows():
+        # Parse the whole date column up front instead of row by row
+        date_keys = self.parse_dates(df_mapped.get('transactiondate', pd.Series(None, index=df_mapped.index, dtype=object)), date_orders)
+        
+        # Generated keys must not collide with the keys this batch keeps as-is
+        self.skip_past_source_ids(df_mapped)
+        
+        # Fetch stored merges for this chunk's passengers in a few batched lookups
+        if 'passengerkey' in df_mapped:
+            numbers = df_mapped['passengerkey'].map(self.source_passenger_number).dropna()
+            self.passenger_resolver.lookup_keys([f"P{int(num)}" for num in numbers.unique()])
+        
+        for index, row in df_mapped.iterrows():
             try:
                 transaction_id = self.clean_transaction_id(row.get('transactionid'))
                 
                 # Clean passenger key (note: CSV has PassengerID, but we map to passengerkey)
                 passenger_key = self.clean_passenger_key(row.get('passengerkey'))
+                passenger_key = self.passenger_resolver.canonical_key(passenger_key)
                 
                 # Clean flight key
                 flight_key = self.clean_flight_key(row.get('flightkey'))
                 
-                # Clean date
-                date_key = self.clean_date(row.get('transactiondate'))
+                date_key = date_keys.loc[index]
+                if pd.isna(date_key):
+                    raise ValueError(f"Unparseable TransactionDate: {row.get('transactiondate')}")
+                date_key = int(date_key)
                 
                 if not all([transaction_id, passenger_key, flight_key, date_key]):
                     raise ValueError("Missing required fields")
@@ -458,12 +640,12 @@ class DataCleaner:
                 }
                 
                 cleaned_data.append(cleaned_row)
+                source_index.append(index)
                 
+            except IdLeaseError:
+                # Not the row's fault: fail the batch so it is retried, not recorded as dirty
+                raise
             except Exception as e:
-                dirty_data.append({
-                    'table_name': 'factairlinesales',
-                    'original_data': row.to_dict(),
-                    'error_reason': str(e)
-                })
+                dirty_data.append(self.dirty_record('factairlinesales', row, e))
         
-        return pd.DataFrame(cleaned_data), dirty_data
+        return pd.DataFrame(cleaned_data, index=source_index), dirty_data
@@ -0,0 +1,233 @@
+import os
+import uuid
+from datetime import datetime
+import numpy as np
+import pandas as pd
+from fallback_manager import FallbackDataManager
+
+# Distinct values tracked per column in the top-K list
+TOP_K = int(os.getenv('PROFILE_TOP_K', 10))
+
+# Sketch sizes: 2^12 HyperLogLog registers (~1.6% error), 4 x 2048 count-min cells
+HLL_PRECISION = 12
+CMS_DEPTH = 4
+CMS_WIDTH = 2048
+
+# Expected formats of the raw key and email columns
+PATTERNS = {
+    'airlinekey': r'^[A-Z]{2}$',
+    'airportkey': r'^[A-Z]{3}$',
+    'originairportkey': r'^[A-Z]{3}$',
+    'destinationairportkey': r'^[A-Z]{3}$',
+    'flightkey': r'^[A-Z]{1,2}\d{3,4}$',
+    'passengerkey': r'^P\d{4,}$',
+    'email': r'^[a-zA-Z0-9._%+-]+@[a-zA-Z0-9.-]+\.[a-zA-Z]{2,}$'
+}
+
+# Applied by migrations/001_warehouse_schema.sql; keep the two in sync
+SUPABASE_SQL = '''
+create table if not exists data_quality_profiles (
+    job_id text primary key,
+    filename text,
+    profiled_at timestamptz not null default now(),
+    profile jsonb not null
+);
+'''
+
+
+def hash_values(values):
+    """64-bit hashes of the text form of non-null values"""
+    return pd.util.hash_pandas_object(values.astype(str), index=False).values
+
+
+class HyperLogLog:
+    """Mergeable distinct-count sketch"""
+
+    def __init__(self, precision=HLL_PRECISION):
+        self.precision = precision
+        self.registers = np.zeros(1 << precision, dtype=np.uint8)
+
+    def update(self, hashes):
+        if len(hashes) == 0:
+            return
+        p = np.uint64(self.precision)
+        index = (hashes >> (np.uint64(64) - p)).astype(np.int64)
+
+        # Rank = position of the lowest set bit in the remaining bits; the
+        # sentinel bit caps it when all remaining bits are zero
+        rest = (hashes & np.uint64((1 << (64 - self.precision)) - 1)) | np.uint64(1 << (64 - self.precision))
+        lowest = rest & (~rest + np.uint64(1))
+        rank = (np.log2(lowest.astype(np.float64)) + 1).astype(np.uint8)
+
+        np.maximum.at(self.registers, index, rank)
+
+    def merge(self, other):
+        np.maximum(self.registers, other.registers, out=self.registers)
+
+    def estimate(self):
+        m = len(self.registers)
+        alpha = 0.7213 / (1 + 1.079 / m)
+        raw = alpha * m * m / np.sum(np.power(2.0, -self.registers.astype(np.float64)))
+        zeros = int(np.count_nonzero(self.registers == 0))
+        if raw <= 2.5 * m and zeros:
+            return int(round(m * np.log(m / zeros)))  # Linear counting for small sets
+        return int(round(raw))
+
+
+class TopK:
+    """Count-min sketch with a mergeable top-K candidate list"""
+
+    def __init__(self, k=TOP_K, depth=CMS_DEPTH, width=CMS_WIDTH):
+        self.k = k
+        self.width = width
+        self.table = np.zeros((depth, width), dtype=np.int64)
+        self.candidates = {}  # value -> estimated count
+
+    def cells(self, hashes):
+        """Column index per sketch row (double hashing from one 64-bit hash)"""
+        low = (hashes & np.uint64(0xFFFFFFFF)).astype(np.int64)
+        high = (hashes >> np.uint64(32)).astype(np.int64)
+        return [(low + i * high) % self.width for i in range(len(self.table))]
+
+    def update(self, values):
+        if values.empty:
+            return
+        for row, cells in enumerate(self.cells(hash_values(values))):
+            np.add.at(self.table[row], cells, 1)
+
+        # Heavy hitters of this chunk compete with the current candidates
+        for value in values.astype(str).value_counts().head(self.k).index:
+            self.candidates[value] = 0
+        self.refresh()
+
+    def estimate(self, values):
+        hashes = hash_values(pd.Series(values, dtype=object))
+        cells = self.cells(hashes)
+        return np.min([self.table[row][cells[row]] for row in range(len(self.table))], axis=0)
+
+    def refresh(self):
+        values = list(self.candidates)
+        counts = self.estimate(values)
+        ranked = sorted(zip(values, counts), key=lambda item: item[1], reverse=True)[:self.k]
+        self.candidates = {value: int(count) for value, count in ranked}
+
+    def merge(self, other):
+        self.table += other.table
+        self.candidates.update(dict.fromkeys(other.candidates, 0))
+        self.refresh()
+
+    def top(self):
+        return [{'value': value, 'count': count} for value, count in self.candidates.items()]
+
+
+class ColumnProfile:
+    """Single-pass statistics for one column"""
+
+    def __init__(self, name):
+        self.name = name
+        self.count = 0
+        self.nulls = 0
+        self.pattern = PATTERNS.get(name)
+        self.pattern_matches = 0
+        self.distinct = HyperLogLog()
+        self.top_values = TopK()
+
+    def update(self, series):
+        values = series.dropna()
+        values = values[values.astype(str).str.strip() != '']
+
+        self.count += len(series)
+        self.nulls += len(series) - len(values)
+        self.distinct.update(hash_values(values))
+        self.top_values.update(values)
+        if self.pattern:
+            self.pattern_matches += int(values.astype(str).str.match(self.pattern).sum())
+
+    def merge(self, other):
+        self.count += other.count
+        self.nulls += other.nulls
+        self.pattern_matches += other.pattern_matches
+        self.distinct.merge(other.distinct)
+        self.top_values.merge(other.top_values)
+
+    def to_dict(self):
+        non_null = self.count - self.nulls
+        profile = {
+            'count': self.count,
+            'nulls': self.nulls,
+            'null_rate': round(self.nulls / self.count, 4) if self.count else 0.0,
+            'distinct_estimate': self.distinct.estimate(),
+            'top_values': self.top_values.top()
+        }
+        if self.pattern:
+            profile['pattern'] = self.pattern
+            profile['pattern_conformance'] = round(self.pattern_matches / non_null, 4) if non_null else None
+        return profile
+
+
+class DataProfile:
+    """Data-quality profile of one upload, built chunk by chunk"""
+
+    def __init__(self, job_id=None, filename=''):
+        self.job_id = job_id or uuid.uuid4().hex
+        self.filename = filename
+        self.tables = {}  # table_name -> {'rows': n, 'columns': {name: ColumnProfile}}
+
+    def update(self, table_name, df):
+        """Fold a chunk (with database column names) into the profile"""
+        table = self.tables.setdefault(table_name, {'rows': 0, 'columns': {}})
+        table['rows'] += len(df)
+        for column in df.columns:
+            if column not in table['columns']:
+                table['columns'][column] = ColumnProfile(column)
+            table['columns'][column].update(df[column])
+
+    def merge(self, other):
+        for table_name, other_table in other.tables.items():
+            table = self.tables.setdefault(table_name, {'rows': 0, 'columns': {}})
+            table['rows'] += other_table['rows']
+            for column, profile in other_table['columns'].items():
+                if column in table['columns']:
+                    table['columns'][column].merge(profile)
+                else:
+                    table['columns'][column] = profile
+
+    def to_dict(self):
+        return {
+            'job_id': self.job_id,
+            'filename': self.filename,
+            'tables': {
+                table_name: {
+                    'rows': table['rows'],
+                    'columns': {name: col.to_dict() for name, col in table['columns'].items()}
+                }
+                for table_name, table in self.tables.items()
+            }
+        }
+
+
+class DataProfiler:
+    """Create per-upload profiles and persist them for trending"""
+
+    def __init__(self, supabase_client):
+        self.supabase = supabase_client
+        self.fallback = FallbackDataManager()
+
+    def profile(self, filename=''):
+        return DataProfile(filename=filename)
+
+    def persist(self, profile):
+        """Store a finished profile, keeping it locally if Supabase is unavailable"""
+        result = profile.to_dict()
+        row = {
+            'job_id': result['job_id'],
+            'filename': result['filename'],
+            'profiled_at': datetime.now().isoformat(),
+            'profile': result
+        }
+        try:
+            self.supabase.table('data_quality_profiles').insert(row).execute()
+        except Exception as e:
+            print(f"❌ Error storing data-quality profile: {e}")
+            self.fallback.save_to_local('data_quality_profiles', [row])
+        return result
@@ -0,0 +1,105 @@
+import os
+import threading
+import pandas as pd
+from fallback_manager import FallbackDataManager
+
+# Calendar range precomputed during warm-up (YYYYMMDD); later dates are added as loads reach them
+DIMDATE_START = os.getenv('DIMDATE_START', '20200101')
+DIMDATE_END = os.getenv('DIMDATE_END', f'{pd.Timestamp.now().year + 1}1231')
+
+# Rows per upsert / read request against dimdate
+DIMDATE_BATCH_SIZE = 1000
+
+# Applied by migrations/001_warehouse_schema.sql; keep the two in sync
+SUPABASE_SQL = '''
+create table if not exists dimdate (
+    datekey int primary key,
+    fulldate date not null,
+    year int not null,
+    quarter int not null,
+    month int not null,
+    monthname text not null,
+    day int not null,
+    dayofweek int not null,
+    dayname text not null,
+    weekofyear int not null,
+    isweekend boolean not null
+);
+'''
+
+
+class DateDimension:
+    """Precomputed calendar rows keyed by the YYYYMMDD datekey used in factairlinesales"""
+
+    def __init__(self, supabase_client):
+        self.supabase = supabase_client
+        self.fallback = FallbackDataManager()
+        self.known = set()
+        self.lock = threading.Lock()
+
+    def build_rows(self, datekeys):
+        """Calendar attributes for each datekey, computed column-wise"""
+        keys = pd.Series(sorted(datekeys), dtype='int64')
+        dates = pd.to_datetime(keys.astype(str), format='%Y%m%d', errors='coerce')
+
+        # A key that is not a real date would fail the whole batch, so it is left out
+        invalid = keys[dates.isna()]
+        if not invalid.empty:
+            print(f"⚠️ Skipping invalid datekeys: {invalid.tolist()[:10]}")
+        keys, dates = keys[dates.notna()], dates.dropna()
+        rows = pd.DataFrame({
+            'datekey': keys,
+            'fulldate': dates.dt.strftime('%Y-%m-%d'),
+            'year': dates.dt.year,
+            'quarter': dates.dt.quarter,
+            'month': dates.dt.month,
+            'monthname': dates.dt.month_name(),
+            'day': dates.dt.day,
+            'dayofweek': dates.dt.dayofweek + 1,  # Monday = 1
+            'dayname': dates.dt.day_name(),
+            'weekofyear': dates.dt.isocalendar().week.astype('int64'),
+            'isweekend': dates.dt.dayofweek >= 5
+        })
+        return rows.to_dict('records')
+
+    def preload(self):
+        """Cache the datekeys already in dimdate and fill in the configured range"""
+        start = 0
+        while True:
+            response = self.supabase.table('dimdate')\
+                .select('datekey')\
+                .range(start, start + DIMDATE_BATCH_SIZE - 1)\
+                .execute()
+            self.known.update(row['datekey'] for row in response.data)
+            if len(response.data) < DIMDATE_BATCH_SIZE:
+                break
+            start += DIMDATE_BATCH_SIZE
+        print(f"📅 Cached {len(self.known)} dimdate rows")
+
+        self.precompute(DIMDATE_START, DIMDATE_END)
+
+    def precompute(self, start, end):
+        """Make sure every day between two YYYYMMDD dates has a dimdate row"""
+        days = pd.date_range(pd.to_datetime(str(start), format='%Y%m%d'),
+                             pd.to_datetime(str(end), format='%Y%m%d'), freq='D')
+        self.ensure_dates(days.year * 10000 + days.month * 100 + days.day)
+
+    def ensure_dates(self, datekeys):
+        """Add dimdate rows for datekeys not stored yet, before facts reference them"""
+        with self.lock:
+            missing = {int(key) for key in datekeys if pd.notna(key)} - self.known
+            if not missing:
+                return
+
+            rows = self.build_rows(missing)
+            for i in range(0, len(rows), DIMDATE_BATCH_SIZE):
+                batch = rows[i:i + DIMDATE_BATCH_SIZE]
+                try:
+                    self.supabase.table('dimdate').upsert(batch).execute()
+                except Exception as e:
+                    print(f"❌ Error storing dimdate rows: {e}")
+                    self.fallback.save_to_local('dimdate', batch)
+                    continue
+                self.known.update(row['datekey'] for row in batch)
+
+            print(f"📅 Added {len(missing)} dimdate rows")
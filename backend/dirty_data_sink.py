@@ -0,0 +1,202 @@
+import math
+import os
+import re
+import threading
+import time
+import uuid
+from collections import Counter
+import pandas as pd
+from fallback_manager import FallbackDataManager
+
+# Rows per insert into dirty_data
+DIRTY_BATCH_SIZE = int(os.getenv('DIRTY_BATCH_SIZE', 500))
+
+# Seconds between background flushes of a partially filled buffer
+DIRTY_FLUSH_INTERVAL = float(os.getenv('DIRTY_FLUSH_INTERVAL', 5))
+
+# Raw payloads kept per (table, reason) in one job; unset keeps every row
+DIRTY_SAMPLE_LIMIT = int(os.getenv('DIRTY_SAMPLE_LIMIT')) if os.getenv('DIRTY_SAMPLE_LIMIT') else None
+
+
+class DirtyDataJob:
+    """Error summary and payload sampling for one ingest job"""
+
+    def __init__(self, sink, job_id, sample_limit=None):
+        self.sink = sink
+        self.job_id = job_id
+        self.sample_limit = sample_limit
+        self.lock = threading.Lock()
+        self.counts = Counter()
+        self.stored = Counter()
+
+    def add(self, dirty_records):
+        """Count dirty rows and pass the sampled ones on to the sink"""
+        kept = []
+        with self.lock:
+            for record in dirty_records:
+                key = (record['table_name'], self.sink.reason_group(record['error_reason']))
+                self.counts[key] += 1
+                if self.sample_limit is None or self.stored[key] < self.sample_limit:
+                    self.stored[key] += 1
+                    kept.append(record)
+
+        self.sink.add(kept)
+
+    def summary(self):
+        """Dirty row counts grouped by table_name and error_reason, largest first"""
+        with self.lock:
+            return [
+                {
+                    'table_name': table_name,
+                    'error_reason': reason,
+                    'count': count,
+                    'stored': self.stored[(table_name, reason)],
+                    'sampled_out': count - self.stored[(table_name, reason)]
+                }
+                for (table_name, reason), count in self.counts.most_common()
+            ]
+
+    def close(self):
+        """Flush everything buffered for the job and return its summary"""
+        self.sink.flush()
+        return self.summary()
+
+
+class DirtyDataSink:
+    """Single writer for dirty_data: bounded batches, timed background flush, local fallback"""
+
+    def __init__(self, supabase_client, batch_size=DIRTY_BATCH_SIZE,
+                 flush_interval=DIRTY_FLUSH_INTERVAL, sample_limit=DIRTY_SAMPLE_LIMIT):
+        self.supabase = supabase_client
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.sample_limit = sample_limit
+        self.fallback = FallbackDataManager()
+
+        self.buffer = []
+        self.lock = threading.Lock()
+        self.fallback_lock = threading.Lock()
+        self.last_flush = time.time()
+        self.stopped = threading.Event()
+        self.flusher = None
+
+    def job(self, job_id=None, sample_limit=None):
+        """Start tracking a new ingest job"""
+        if sample_limit is None:
+            sample_limit = self.sample_limit
+        return DirtyDataJob(self, job_id or uuid.uuid4().hex, sample_limit)
+
+    def reason_group(self, error_reason):
+        """Strip row-specific detail so similar failures group together"""
+        # e.g. "Duplicate key: {...details...}" -> "Duplicate key"
+        text = str(error_reason)
+        label = text.split(':', 1)[0].strip()
+        if not label.startswith('{'):
+            return label
+
+        # Raw PostgREST errors are dicts: group by their code and message,
+        # leaving out 'details', which holds the row's values
+        code = re.search(r"""['"]code['"]:\s*['"]([^'"]+)['"]""", text)
+        message = re.search(r"""['"]message['"]:\s*(['"])(.*?)(?<!\\)\1""", text)
+        if code and message:
+            return f"{code.group(1)} {message.group(2)}"
+        if code or message:
+            return code.group(1) if code else message.group(2)
+        return 'Insert error'
+
+    def normalize(self, record):
+        """Make a dirty record JSON-safe, converting the raw row only now"""
+        original = record.get('original_data')
+        if isinstance(original, pd.Series):
+            original = original.to_dict()
+        if isinstance(original, dict):
+            original = {str(k): self.json_value(v) for k, v in original.items()}
+
+        return {
+            'table_name': record['table_name'],
+            'original_data': original,
+            'error_reason': str(record['error_reason'])
+        }
+
+    def json_value(self, value):
+        """Convert NaN, numpy scalars and timestamps to plain JSON values"""
+        if hasattr(value, 'isoformat'):
+            return value.isoformat()
+        if hasattr(value, 'item') and not isinstance(value, (str, bytes)):
+            value = value.item()
+        if isinstance(value, float) and math.isnan(value):
+            return None
+        return value
+
+    def add(self, dirty_records):
+        """Buffer dirty rows, writing full batches straight away"""
+        if not dirty_records:
+            return
+
+        records = [self.normalize(record) for record in dirty_records]
+        full_batches = []
+        with self.lock:
+            self.buffer.extend(records)
+            while len(self.buffer) >= self.batch_size:
+                full_batches.append(self.buffer[:self.batch_size])
+                self.buffer = self.buffer[self.batch_size:]
+
+        for batch in full_batches:
+            self.write_batch(batch)
+
+        self.start_flusher()
+
+    def flush(self):
+        """Write whatever is buffered"""
+        with self.lock:
+            pending, self.buffer = self.buffer, []
+            self.last_flush = time.time()
+
+        for i in range(0, len(pending), self.batch_size):
+            self.write_batch(pending[i:i + self.batch_size])
+
+    def write_batch(self, batch):
+        """Insert one bounded batch, saving it locally if Supabase rejects it"""
+        try:
+            self.supabase.table('dirty_data').insert(batch).execute()
+            print(f"🗑️ Stored {len(batch)} dirty records")
+            return True
+        except Exception as e:
+            print(f"❌ Error storing dirty data: {e}")
+            with self.fallback_lock:
+                return self.fallback.save_dirty_data(batch)
+
+    def start_flusher(self):
+        """Start the background thread that flushes partially filled buffers"""
+        if self.flusher is not None:
+            return
+
+        with self.lock:
+            if self.flusher is not None:
+                return
+            self.flusher = threading.Thread(target=self.run_flusher, daemon=True)
+            self.flusher.start()
+
+    def run_flusher(self):
+        while not self.stopped.wait(self.flush_interval):
+            if self.buffer and time.time() - self.last_flush >= self.flush_interval:
+                self.flush()
+
+    def close(self):
+        """Stop the background thread and flush what is left"""
+        self.stopped.set()
+        self.flush()
+
+    @staticmethod
+    def merge_summaries(summaries):
+        """Merge job summaries from several files into one"""
+        merged = {}
+        for summary in summaries:
+            for entry in summary or []:
+                key = (entry['table_name'], entry['error_reason'])
+                if key not in merged:
+                    merged[key] = dict(entry)
+                else:
+                    for field in ('count', 'stored', 'sampled_out'):
+                        merged[key][field] += entry[field]
+        return sorted(merged.values(), key=lambda entry: entry['count'], reverse=True)
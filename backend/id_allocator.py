@@ -0,0 +1,132 @@
+import os
+import threading
+import time
+
+# Ids leased per round trip; unused ids in a block are skipped on restart
+ID_BLOCK_SIZE = int(os.getenv('ID_BLOCK_SIZE', 1000))
+
+# Attempts per lease, and the first backoff delay in seconds (doubled each retry)
+LEASE_RETRIES = int(os.getenv('ID_LEASE_RETRIES', 4))
+LEASE_BACKOFF = float(os.getenv('ID_LEASE_BACKOFF', 0.5))
+
+# Seconds later leases fail fast after the sequence could not be reached
+LEASE_COOLDOWN = float(os.getenv('ID_LEASE_COOLDOWN', 10))
+
+# First id handed out by each sequence
+SEQUENCE_STARTS = {
+    'passenger': 1001,
+    'transaction': 40001
+}
+
+# Applied by migrations/001_warehouse_schema.sql so every loader shares one sequence.
+# Each lease also skips past the largest key already stored, since source
+# ids at or above the sequence start are loaded unchanged
+SUPABASE_SQL = '''
+create table if not exists id_sequences (
+    name text primary key,
+    next_value bigint not null
+);
+
+drop function if exists lease_id_block(text, int, bigint);
+
+create or replace function lease_id_block(seq_name text, block_size int, start_value bigint, min_value bigint default 0)
+returns bigint language plpgsql as $$
+declare
+    used_value bigint;
+    first_value bigint;
+begin
+    if seq_name = 'passenger' then
+        select max(substring(passengerkey from 2)::bigint) into used_value
+        from passengers where passengerkey ~ '^P[0-9]+$';
+    elsif seq_name = 'transaction' then
+        select max(transactionid) into used_value from factairlinesales;
+    end if;
+
+    insert into id_sequences as s (name, next_value)
+    values (seq_name, greatest(start_value, min_value, coalesce(used_value + 1, start_value)) + block_size)
+    on conflict (name) do update
+        set next_value = greatest(s.next_value, min_value, coalesce(used_value + 1, 0)) + block_size
+    returning next_value - block_size into first_value;
+
+    return first_value;
+end;
+$$;
+'''
+
+
+class IdLeaseError(RuntimeError):
+    """The shared sequence could not be reached; the batch needing ids must be retried"""
+
+
+class IdAllocator:
+    """Hand out surrogate ids locally from blocks leased off the shared Supabase sequence"""
+
+    def __init__(self, supabase_client, block_size=ID_BLOCK_SIZE):
+        self.supabase = supabase_client
+        self.block_size = block_size
+        self.blocks = {}  # sequence -> [next id, end of block]
+        self.floors = {}  # sequence -> largest id used by source rows kept as-is
+        self.unavailable_until = 0.0
+        self.lock = threading.Lock()
+
+    def next_id(self, sequence):
+        """Next unused id from the sequence; only leasing a block needs coordination"""
+        with self.lock:
+            block = self.blocks.get(sequence)
+            if block is None or block[0] >= block[1]:
+                start = self.lease_block(sequence)
+                block = [start, start + self.block_size]
+                self.blocks[sequence] = block
+
+            value = block[0]
+            block[0] += 1
+            return value
+
+    def reserve(self, sequence):
+        """Lease a block ahead of time so the first id needs no round trip"""
+        with self.lock:
+            block = self.blocks.get(sequence)
+            if block is None or block[0] >= block[1]:
+                start = self.lease_block(sequence)
+                self.blocks[sequence] = [start, start + self.block_size]
+
+    def skip_past(self, sequence, value):
+        """Hand out only ids above value from now on, e.g. past source keys loaded unchanged"""
+        with self.lock:
+            if value <= self.floors.get(sequence, 0):
+                return
+            self.floors[sequence] = value
+            block = self.blocks.get(sequence)
+            if block is not None and block[0] <= value:
+                # Skip within the current block; an exhausted block is re-leased past value
+                block[0] = min(value + 1, block[1])
+
+    def lease_block(self, sequence):
+        """Reserve block_size ids and return the first one
+
+        There is no local fallback: ids minted without the shared sequence
+        would collide with other loaders, so the lease is retried with
+        backoff and then raises IdLeaseError, leaving the batch to be retried.
+        """
+        if time.time() < self.unavailable_until:
+            raise IdLeaseError(f"Id sequence unavailable: could not lease a {sequence} block")
+
+        delay = LEASE_BACKOFF
+        for attempt in range(1, LEASE_RETRIES + 1):
+            try:
+                response = self.supabase.rpc('lease_id_block', {
+                    'seq_name': sequence,
+                    'block_size': self.block_size,
+                    'start_value': SEQUENCE_STARTS.get(sequence, 1),
+                    'min_value': self.floors.get(sequence, 0) + 1
+                }).execute()
+                return int(response.data)
+            except Exception as e:
+                print(f"⚠️ Leasing {sequence} ids failed (attempt {attempt}/{LEASE_RETRIES}): {e}")
+                if attempt < LEASE_RETRIES:
+                    time.sleep(delay)
+                    delay *= 2
+
+        # Rows cleaned during the cooldown fail straight away instead of each waiting out the backoff
+        self.unavailable_until = time.time() + LEASE_COOLDOWN
+        raise IdLeaseError(f"Id sequence unavailable: could not lease a {sequence} block")
@@ -0,0 +1,152 @@
+import hashlib
+import io
+import os
+import sqlite3
+import threading
+from datetime import datetime
+import pandas as pd
+
+# Local manifest shared by every loader on this host
+MANIFEST_PATH = os.getenv('INGEST_MANIFEST_PATH', 'local_data/ingest_manifest.db')
+
+# Hashes looked up per SQLite query (stays under the bound-variable limit)
+LOOKUP_BATCH_SIZE = 500
+
+
+class HashingStream(io.RawIOBase):
+    """Compute the SHA-256 of a stream that cannot be rewound while it is being read"""
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.digest = hashlib.sha256()
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        data = self.stream.read(len(buffer))
+        if not data:
+            return 0
+        self.digest.update(data)
+        buffer[:len(data)] = data
+        return len(data)
+
+    def hexdigest(self):
+        """Hash of the whole stream, reading whatever the consumer left unread"""
+        while True:
+            block = self.stream.read(1024 * 1024)
+            if not block:
+                break
+            self.digest.update(block)
+        return self.digest.hexdigest()
+
+
+class IngestManifest:
+    """Content fingerprints of ingested files and rows, used to load only the delta"""
+
+    def __init__(self, db_path=MANIFEST_PATH):
+        self.db_path = db_path
+        directory = os.path.dirname(db_path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(db_path, timeout=30, check_same_thread=False)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('''
+            CREATE TABLE IF NOT EXISTS ingest_files (
+                file_hash TEXT PRIMARY KEY,
+                filename TEXT,
+                table_name TEXT,
+                row_count INTEGER,
+                ingested_at TEXT
+            )
+        ''')
+        self.conn.execute('''
+            CREATE TABLE IF NOT EXISTS ingest_rows (
+                table_name TEXT NOT NULL,
+                row_hash INTEGER NOT NULL,
+                PRIMARY KEY (table_name, row_hash)
+            ) WITHOUT ROWID
+        ''')
+        self.conn.commit()
+
+    def hash_stream(self, stream):
+        """SHA-256 of a seekable stream, leaving it at its original position"""
+        start = stream.tell()
+        digest = hashlib.sha256()
+        while True:
+            block = stream.read(1024 * 1024)
+            if not block:
+                break
+            digest.update(block)
+        stream.seek(start)
+        return digest.hexdigest()
+
+    def hash_bytes(self, data):
+        """SHA-256 of an in-memory payload such as a Kafka message"""
+        return hashlib.sha256(data).hexdigest()
+
+    def has_file(self, file_hash):
+        """True if a file with this content was already ingested"""
+        with self.lock:
+            row = self.conn.execute(
+                'SELECT 1 FROM ingest_files WHERE file_hash = ?', (file_hash,)
+            ).fetchone()
+        return row is not None
+
+    def record_file(self, file_hash, filename, table_name, row_count):
+        """Remember a fully ingested file"""
+        with self.lock:
+            self.conn.execute(
+                'INSERT OR REPLACE INTO ingest_files VALUES (?, ?, ?, ?, ?)',
+                (file_hash, filename, str(table_name), row_count, datetime.now().isoformat())
+            )
+            self.conn.commit()
+
+    def row_hashes(self, df):
+        """64-bit fingerprint of every row's raw values"""
+        # Hash a normalized text form so a value hashes the same whatever
+        # dtype the chunk happened to infer (e.g. 5 vs 5.0 when a column has NaNs)
+        text = df.astype(str).where(df.notna(), '')
+        for column in df.columns[[pd.api.types.is_float_dtype(t) for t in df.dtypes]]:
+            text[column] = text[column].str.replace(r'\.0$', '', regex=True)
+        hashes = pd.util.hash_pandas_object(text, index=False)
+        return hashes.astype('int64')
+
+    def filter_new_rows(self, table_name, df):
+        """Drop rows already ingested (or repeated within df); returns (new rows, their hashes)"""
+        if df.empty:
+            return df, []
+
+        hashes = self.row_hashes(df)
+        unique = ~hashes.duplicated()
+        seen = self.seen_hashes(table_name, hashes[unique].tolist())
+
+        keep = unique & ~hashes.isin(seen)
+        return df[keep.values], hashes[keep].tolist()
+
+    def seen_hashes(self, table_name, hashes):
+        """Subset of hashes already recorded for a table"""
+        seen = set()
+        with self.lock:
+            for i in range(0, len(hashes), LOOKUP_BATCH_SIZE):
+                batch = hashes[i:i + LOOKUP_BATCH_SIZE]
+                placeholders = ','.join('?' * len(batch))
+                rows = self.conn.execute(
+                    f'SELECT row_hash FROM ingest_rows WHERE table_name = ? AND row_hash IN ({placeholders})',
+                    [table_name, *batch]
+                ).fetchall()
+                seen.update(row[0] for row in rows)
+        return seen
+
+    def record_rows(self, table_name, hashes):
+        """Remember rows once they have been loaded or routed to dirty_data"""
+        if not hashes:
+            return
+        with self.lock:
+            self.conn.executemany(
+                'INSERT OR IGNORE INTO ingest_rows VALUES (?, ?)',
+                ((table_name, h) for h in hashes)
+            )
+            self.conn.commit()
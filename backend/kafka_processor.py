@@ -1,13 +1,46 @@
 import json
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
 import pandas as pd
-from confluent_kafka import Producer, Consumer
-from data_cleaner import DataCleaner
+from confluent_kafka import Producer, Consumer, TopicPartition
+from data_cleaner import DataCleaner, InsertError, TABLE_ALIASES, TARGET_TABLES
+from date_dimension import DateDimension
+from dirty_data_sink import DirtyDataSink
+from ingest_manifest import IngestManifest
+from sales_aggregates import SalesAggregator
+from fallback_manager import FallbackDataManager
 import os
 
+# Attempts per message before it goes to the dead-letter topic
+KAFKA_MAX_RETRIES = int(os.getenv('KAFKA_MAX_RETRIES', 3))
+KAFKA_RETRY_BACKOFF = float(os.getenv('KAFKA_RETRY_BACKOFF', 1.0))
+DLQ_SUFFIX = '-dlq'
+
+# Backpressure: pause partitions above these limits
+KAFKA_WORKERS = int(os.getenv('KAFKA_WORKERS', 4))
+KAFKA_MAX_IN_FLIGHT = int(os.getenv('KAFKA_MAX_IN_FLIGHT', 8))
+KAFKA_MAX_WRITE_LATENCY = float(os.getenv('KAFKA_MAX_WRITE_LATENCY', 5.0))
+
 class KafkaDataProcessor:
     def __init__(self, supabase_client, bootstrap_servers='localhost:9092'):
         self.supabase = supabase_client
         self.cleaner = DataCleaner(supabase_client)
+        self.manifest = IngestManifest()
+        self.dirty_sink = DirtyDataSink(supabase_client)
+        self.sales_aggregates = SalesAggregator(supabase_client)
+        self.date_dimension = DateDimension(supabase_client)
+        self.fallback = FallbackDataManager()
+        
+        # In-flight offsets per (topic, partition), and consumer load state
+        self.in_flight = {}
+        self.offsets_lock = threading.Lock()
+        self.write_latency = 0.0
+        self.paused = False
+        
+        # Cleaned-data records already handled per message hash, so a retry resumes after them
+        self.load_progress = {}
         
         # Kafka configuration
         self.producer_config = {
@@ -18,7 +51,9 @@ class KafkaDataProcessor:
         self.consumer_config = {
             'bootstrap.servers': bootstrap_servers,
             'group.id': 'airline-data-group',
-            'auto.offset.reset': 'earliest'
+            'auto.offset.reset': 'earliest',
+            # Offsets are committed once a message is processed or dead-lettered
+            'enable.auto.commit': False
         }
         
         self.producer = Producer(self.producer_config)
@@ -42,9 +77,20 @@ class KafkaDataProcessor:
         self.producer.flush()
     
     def process_raw_data(self):
-        """Consume and process raw data from Kafka"""
+        """Consume and process raw and cleaned data from Kafka
+
+        Messages are handled by a worker pool. Offsets are committed only once a
+        message was processed or parked in its dead-letter topic, and partitions
+        are paused while too many batches are in flight or Supabase writes slow
+        down, so the consumer never outruns the warehouse.
+        """
+        executor = ThreadPoolExecutor(max_workers=KAFKA_WORKERS)
+        
         while True:
-            msg = self.consumer.poll(1.0)
+            self.commit_finished()
+            self.apply_backpressure()
+            
+            msg = self.consumer.poll(0.1 if self.paused else 1.0)
             
             if msg is None:
                 continue
@@ -52,38 +98,170 @@ class KafkaDataProcessor:
                 print(f"Consumer error: {msg.error()}")
                 continue
             
+            self.track_message(msg)
+            executor.submit(self.process_with_retry, msg)
+    
+    def process_with_retry(self, msg):
+        """Handle one message with bounded retries, then dead-letter it"""
+        try:
+            for attempt in range(1, KAFKA_MAX_RETRIES + 1):
+                start = time.time()
+                try:
+                    self.handle_message(msg)
+                    self.record_latency(time.time() - start)
+                    return
+                except (ValueError, KeyError) as e:
+                    # Malformed payloads will never succeed, so skip the retries
+                    print(f"Error processing message: {e}")
+                    self.send_to_dlq(msg, e, attempt)
+                    return
+                except Exception as e:
+                    self.record_latency(time.time() - start)
+                    print(f"Error processing message (attempt {attempt}/{KAFKA_MAX_RETRIES}): {e}")
+                    if attempt == KAFKA_MAX_RETRIES:
+                        self.send_to_dlq(msg, e, attempt)
+                    else:
+                        time.sleep(KAFKA_RETRY_BACKOFF * 2 ** (attempt - 1))
+        finally:
+            if msg.value():
+                self.load_progress.pop(self.manifest.hash_bytes(msg.value()), None)
+            self.finish_message(msg)
+    
+    def handle_message(self, msg):
+        """Clean a raw-data message or load a cleaned-data message"""
+        # Redelivered or re-sent messages are skipped outright
+        message_hash = self.manifest.hash_bytes(msg.value())
+        if self.manifest.has_file(message_hash):
+            print("Skipping message: already processed")
+            return
+        
+        data = json.loads(msg.value())
+        table_name = data['table_name']
+        
+        # Cleaned batches are loaded into the warehouse
+        if msg.topic() == 'cleaned-data':
+            self.load_cleaned_data(table_name, data['data'], message_hash)
+            self.manifest.record_file(message_hash, f"{msg.topic()}:{msg.partition()}:{msg.offset()}", table_name, len(data['data']))
+            return
+        
+        raw_df = pd.DataFrame(data['data'])
+        
+        # Only rows not seen in an earlier message are cleaned
+        manifest_table = TABLE_ALIASES.get(table_name, table_name)
+        total_rows = len(raw_df)
+        raw_df, row_hashes = self.manifest.filter_new_rows(manifest_table, raw_df)
+        if len(raw_df) < total_rows:
+            print(f"Skipped {total_rows - len(raw_df)} already processed records")
+        if raw_df.empty:
+            self.manifest.record_file(message_hash, f"{msg.topic()}:{msg.partition()}:{msg.offset()}", table_name, total_rows)
+            return
+        
+        print(f"Processing {len(raw_df)} records for {table_name}")
+        
+        # Clean the data based on table type
+        if table_name == 'airlines':
+            cleaned_df, dirty_data = self.cleaner.process_airlines_data(raw_df)
+        elif table_name == 'airports':
+            cleaned_df, dirty_data = self.cleaner.process_airports_data(raw_df)
+        elif table_name == 'passengers':
+            cleaned_df, dirty_data = self.cleaner.process_passengers_data(raw_df)
+        elif table_name == 'flights':
+            cleaned_df, dirty_data = self.cleaner.process_flights_data(raw_df)
+        elif table_name == 'sales':
+            cleaned_df, dirty_data = self.cleaner.process_sales_data(raw_df)
+        else:
+            raise ValueError(f"Unknown table: {table_name}")
+        
+        # Send cleaned data to next topic
+        if not cleaned_df.empty:
+            self.produce_cleaned_data(table_name, cleaned_df)
+        
+        # Store dirty data
+        if dirty_data:
+            self.store_dirty_data(dirty_data)
+        
+        self.manifest.record_rows(manifest_table, row_hashes)
+        self.manifest.record_file(message_hash, f"{msg.topic()}:{msg.partition()}:{msg.offset()}", table_name, total_rows)
+    
+    def send_to_dlq(self, msg, error, attempts):
+        """Park a failed message, with its error context, in <topic>-dlq"""
+        dlq_topic = f"{msg.topic()}{DLQ_SUFFIX}"
+        record = {
+            'topic': msg.topic(),
+            'partition': msg.partition(),
+            'offset': msg.offset(),
+            'error': str(error),
+            'error_type': type(error).__name__,
+            'attempts': attempts,
+            'failed_at': datetime.now().isoformat(),
+            'payload': msg.value().decode('utf-8', errors='replace') if msg.value() else None
+        }
+        
+        try:
+            self.producer.produce(dlq_topic, key=msg.key(), value=json.dumps(record))
+            self.producer.flush()
+            print(f"Sent message {msg.topic()}:{msg.partition()}:{msg.offset()} to {dlq_topic}")
+        except Exception as e:
+            # Keep the message locally rather than lose it
+            print(f"Error sending to {dlq_topic}: {e}")
+            self.fallback.save_to_local(dlq_topic, [record])
+    
+    def track_message(self, msg):
+        """Remember a message as in flight until it is finished"""
+        with self.offsets_lock:
+            partition = self.in_flight.setdefault((msg.topic(), msg.partition()), {})
+            partition[msg.offset()] = False
+    
+    def finish_message(self, msg):
+        with self.offsets_lock:
+            self.in_flight[(msg.topic(), msg.partition())][msg.offset()] = True
+    
+    def in_flight_count(self):
+        with self.offsets_lock:
+            return sum(
+                1 for offsets in self.in_flight.values() for done in offsets.values() if not done
+            )
+    
+    def commit_finished(self):
+        """Commit, per partition, the offsets up to the first unfinished message"""
+        to_commit = []
+        with self.offsets_lock:
+            for (topic, partition), offsets in self.in_flight.items():
+                last_done = None
+                for offset in sorted(offsets):
+                    if not offsets[offset]:
+                        break
+                    last_done = offset
+                    del offsets[offset]
+                if last_done is not None:
+                    to_commit.append(TopicPartition(topic, partition, last_done + 1))
+        
+        if to_commit:
             try:
-                data = json.loads(msg.value())
-                table_name = data['table_name']
-                raw_df = pd.DataFrame(data['data'])
-                
-                print(f"Processing {len(raw_df)} records for {table_name}")
-                
-                # Clean the data based on table type
-                if table_name == 'airlines':
-                    cleaned_df, dirty_data = self.cleaner.process_airlines_data(raw_df)
-                elif table_name == 'airports':
-                    cleaned_df, dirty_data = self.cleaner.process_airports_data(raw_df)
-                elif table_name == 'passengers':
-                    cleaned_df, dirty_data = self.cleaner.process_passengers_data(raw_df)
-                elif table_name == 'flights':
-                    cleaned_df, dirty_data = self.cleaner.process_flights_data(raw_df)
-                elif table_name == 'sales':
-                    cleaned_df, dirty_data = self.cleaner.process_sales_data(raw_df)
-                else:
-                    print(f"Unknown table: {table_name}")
-                    continue
-                
-                # Send cleaned data to next topic
-                if not cleaned_df.empty:
-                    self.produce_cleaned_data(table_name, cleaned_df)
-                
-                # Store dirty data
-                if dirty_data:
-                    self.store_dirty_data(dirty_data)
-                    
+                self.consumer.commit(offsets=to_commit, asynchronous=True)
             except Exception as e:
-                print(f"Error processing message: {e}")
+                print(f"Error committing offsets: {e}")
+    
+    def record_latency(self, seconds):
+        """Exponentially weighted average of per-message write latency"""
+        with self.offsets_lock:
+            self.write_latency = 0.8 * self.write_latency + 0.2 * seconds
+    
+    def apply_backpressure(self):
+        """Pause partitions when the warehouse falls behind, resume once it catches up"""
+        in_flight = self.in_flight_count()
+        latency = self.write_latency
+        
+        if not self.paused and (in_flight >= KAFKA_MAX_IN_FLIGHT or latency > KAFKA_MAX_WRITE_LATENCY):
+            partitions = self.consumer.assignment()
+            if partitions:
+                self.consumer.pause(partitions)
+                self.paused = True
+                print(f"Paused consumption: {in_flight} in flight, {latency:.2f}s write latency")
+        elif self.paused and in_flight <= KAFKA_MAX_IN_FLIGHT // 2 and (latency <= KAFKA_MAX_WRITE_LATENCY or in_flight == 0):
+            self.consumer.resume(self.consumer.assignment())
+            self.paused = False
+            print(f"Resumed consumption: {in_flight} in flight, {latency:.2f}s write latency")
     
     def produce_cleaned_data(self, table_name, cleaned_df):
         """Send cleaned data to Kafka topic"""
@@ -99,10 +277,55 @@ class KafkaDataProcessor:
         )
         self.producer.flush()
     
+    def load_cleaned_data(self, table_name, records, message_hash=None):
+        """Insert a cleaned batch and fold new sales into the summary totals
+        
+        Supabase failures that are not about a single row raise, so the
+        message is retried and finally dead-lettered; a retry skips the
+        records an earlier attempt already handled.
+        """
+        target_table = TARGET_TABLES.get(TABLE_ALIASES.get(table_name, table_name))
+        if target_table is None:
+            raise ValueError(f"Unknown table: {table_name}")
+        
+        if target_table == 'factairlinesales':
+            self.date_dimension.ensure_dates(record.get('datekey') for record in records)
+        
+        start = self.load_progress.get(message_hash, 0)
+        try:
+            inserted_records, duplicate_errors = self.cleaner.insert_data_with_duplicate_handling(
+                target_table, records[start:], raise_errors=True
+            )
+        except InsertError as e:
+            self.load_progress[message_hash] = start + e.handled
+            self.finish_load(target_table, e.inserted_records, e.duplicate_errors)
+            raise
+        
+        self.finish_load(target_table, inserted_records, duplicate_errors)
+    
+    def finish_load(self, target_table, inserted_records, duplicate_errors):
+        """Store the dirty rows of a (partial) load and update the summary totals"""
+        print(f"Loaded {len(inserted_records)} records into {target_table}, {len(duplicate_errors)} duplicates/errors")
+        
+        if duplicate_errors:
+            self.store_dirty_data(duplicate_errors)
+        
+        if target_table == 'factairlinesales':
+            self.sales_aggregates.apply(inserted_records)
+        
+        # Later messages are matched only against passengers that were stored
+        if target_table == 'passengers':
+            self.cleaner.passenger_resolver.confirm(inserted_records)
+    
     def store_dirty_data(self, dirty_data):
-        """Store dirty data in Supabase"""
-        for dirty_row in dirty_data:
-            try:
-                self.supabase.table('dirty_data').insert(dirty_row).execute()
-            except Exception as e:
-                print(f"Error storing dirty data: {e}")
+        """Store dirty data and return the message's error summary"""
+        # Flushed before returning, since the message's offset is committed
+        # once it is finished; the sink falls back to local_data if Supabase
+        # is unavailable
+        job = self.dirty_sink.job()
+        job.add(dirty_data)
+        
+        summary = job.close()
+        for entry in summary:
+            print(f"Dirty {entry['table_name']}: {entry['count']} x {entry['error_reason']}")
+        return summary
@@ -1,143 +1,523 @@
+import io
 import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from supabase import create_client
-from data_cleaner import DataCleaner
+from data_cleaner import DataCleaner, TABLE_ALIASES
+from data_profiler import DataProfiler
+from date_dimension import DateDimension
+from dirty_data_sink import DirtyDataSink
+from id_allocator import SEQUENCE_STARTS
+from ingest_manifest import HashingStream, IngestManifest
+from sales_aggregates import SalesAggregator
+from stream_reader import StreamReader
 import pandas as pd
 from dotenv import load_dotenv
 
 # Load environment variables
 load_dotenv()
 
+# Zip members processed at the same time
+UPLOAD_MAX_WORKERS = int(os.getenv('UPLOAD_MAX_WORKERS', 4))
+
+# Zip members are loaded in these stages so the tables a row references are
+# filled first; members of one stage run in parallel, unknown members run last
+TABLE_LOAD_ORDER = {
+    'airlines': 0,
+    'airports': 0,
+    'flights': 1,
+    'passengers': 1,
+    'travel_agency_sales_001': 2
+}
+
+# Tables the loaders read or write; all but the warehouse tables come from
+# migrations/001_warehouse_schema.sql
+SCHEMA_TABLES = ['airlines', 'airports', 'flights', 'passengers', 'factairlinesales', 'dirty_data',
+                 'dimdate', 'id_sequences', 'passenger_key_map', 'sales_summary', 'data_quality_profiles']
+
+# Error codes for a table or function that does not exist (Postgres / PostgREST)
+MISSING_OBJECT_CODES = {'42P01', '42883', 'PGRST202', 'PGRST205'}
+
+class MissingSchemaError(RuntimeError):
+    """Supabase lacks tables or functions the loaders need"""
+    
+    def __init__(self, missing):
+        super().__init__(f"Missing from Supabase: {', '.join(missing)} (run backend/migrations/001_warehouse_schema.sql)")
+        self.missing = missing
+
+# One Supabase client per process, shared by every service
+_supabase_client = None
+_supabase_lock = threading.Lock()
+
+def get_supabase_client():
+    """Create the shared Supabase client on first use"""
+    global _supabase_client
+    if _supabase_client is None:
+        with _supabase_lock:
+            if _supabase_client is None:
+                _supabase_client = create_client(os.getenv('SUPABASE_URL'), os.getenv('SUPABASE_KEY'))
+    return _supabase_client
+
 class DataWarehouseManager:
     def __init__(self):
         self.supabase_url = os.getenv('SUPABASE_URL')
         self.supabase_key = os.getenv('SUPABASE_KEY')
-        self.supabase = create_client(self.supabase_url, self.supabase_key)
+        self.supabase = get_supabase_client()
         self.cleaner = DataCleaner(self.supabase)
+        self.reader = StreamReader()
+        self.manifest = IngestManifest()
+        self.dirty_sink = DirtyDataSink(self.supabase)
+        self.sales_aggregates = SalesAggregator(self.supabase)
+        self.profiler = DataProfiler(self.supabase)
+        self.date_dimension = DateDimension(self.supabase)
+    
+    def check_schema(self):
+        """Names of the tables and functions the loaders need that Supabase lacks"""
+        probes = [(f'table {name}', lambda name=name: self.supabase.table(name).select('*').limit(1).execute())
+                  for name in SCHEMA_TABLES]
+        probes += [
+            # Each call leaves the data as it is
+            ('function lease_id_block', lambda: self.supabase.rpc('lease_id_block', {
+                'seq_name': 'passenger', 'block_size': 0,
+                'start_value': SEQUENCE_STARTS['passenger'], 'min_value': 0
+            }).execute()),
+            ('function apply_sales_deltas', lambda: self.supabase.rpc('apply_sales_deltas', {'deltas': []}).execute()),
+            ('function query_sales_summary', lambda: self.supabase.rpc('query_sales_summary', {
+                'group_by': [], 'date_from': 1, 'date_to': 0
+            }).execute())
+        ]
+        
+        missing = []
+        for name, probe in probes:
+            try:
+                probe()
+            except Exception as e:
+                # Anything else (e.g. Supabase unreachable) fails the warm-up as usual
+                if self.cleaner.error_code(e) not in MISSING_OBJECT_CODES:
+                    raise
+                missing.append(name)
+        return missing
+    
+    def warm_up(self):
+        """Preload key indexes and caches so the first upload does not pay for them"""
+        print("🔥 Warming up data warehouse manager")
+        missing = self.check_schema()
+        if missing:
+            raise MissingSchemaError(missing)
+        self.sales_aggregates.preload_routes()
+        self.date_dimension.preload()
+        self.cleaner.passenger_resolver.preload_key_map()
+        for sequence in ('passenger', 'transaction'):
+            self.cleaner.id_allocator.reserve(sequence)
+        print("✅ Warm-up complete")
     
     def detect_table_type(self, file_path):
         """Detect what type of table the CSV file contains"""
         try:
             df = pd.read_csv(file_path, nrows=1)  # Read just the header
-            
-            # Check columns to determine table type
-            columns = [col.lower() for col in df.columns]
-            
-            if 'airlinekey' in columns or 'airlinename' in columns:
-                return 'airlines'
-            elif 'airportkey' in columns or 'airportname' in columns:
-                return 'airports' 
-            elif 'flightkey' in columns and ('originairportkey' in columns or 'destinationairportkey' in columns):
-                return 'flights'
-            elif 'passengerkey' in columns or 'fullname' in columns:
-                return 'passengers'
-            elif 'transactionid' in columns and ('passengerid' in columns or 'flightid' in columns):
-                return 'travel_agency_sales_001'
-            else:
-                return 'unknown'
+            return self.detect_table_type_from_columns(df.columns)
                 
         except Exception as e:
             print(f"Error detecting table type: {e}")
             return 'unknown'
     
+    def detect_table_type_from_columns(self, columns):
+        """Detect the table type from a list of column names"""
+        # Check columns to determine table type
+        columns = [str(col).lower() for col in columns]
+        
+        if 'airlinekey' in columns or 'airlinename' in columns:
+            return 'airlines'
+        elif 'airportkey' in columns or 'airportname' in columns:
+            return 'airports' 
+        elif 'flightkey' in columns and ('originairportkey' in columns or 'destinationairportkey' in columns):
+            return 'flights'
+        elif 'passengerkey' in columns or 'fullname' in columns:
+            return 'passengers'
+        elif 'transactionid' in columns and ('passengerid' in columns or 'flightid' in columns):
+            return 'travel_agency_sales_001'
+        else:
+            return 'unknown'
+    
+    def get_table_processor(self, table_name):
+        """Return (cleaning function, target table, key column) for a table type"""
+        table_name = TABLE_ALIASES.get(table_name, table_name)
+        
+        if table_name == 'airlines':
+            return self.cleaner.process_airlines_data, 'airlines', 'airlinekey'
+        elif table_name == 'airports':
+            return self.cleaner.process_airports_data, 'airports', 'airportkey'
+        elif table_name == 'flights':
+            return self.cleaner.process_flights_data, 'flights', 'flightkey'
+        elif table_name == 'passengers':
+            return self.cleaner.process_passengers_data, 'passengers', 'passengerkey'
+        elif table_name == 'travel_agency_sales_001':
+            return self.cleaner.process_sales_data, 'factairlinesales', 'transactionid'
+        else:
+            return None
+    
     def upload_file(self, file_path, table_name=None):
-        """Upload and process a CSV file with proper duplicate handling"""
+        """Upload and process a CSV, Parquet or Arrow file (plain, gzip, zstd or zip) from disk"""
+        try:
+            with open(file_path, 'rb') as f:
+                return self.upload_stream(f, os.path.basename(file_path), table_name)
+        except Exception as e:
+            print(f"❌ Error uploading file: {e}")
+            return {'error': str(e)}
+    
+    def upload_stream(self, stream, filename='', table_name=None):
+        """Upload and process a binary stream without writing a temp copy"""
+        try:
+            # Skip files whose exact content was already ingested; streams that
+            # cannot be rewound are hashed while they are read and checked at the end
+            file_hash = None
+            hashing = None
+            if not stream.seekable():
+                hashing = HashingStream(stream)
+                stream = io.BufferedReader(hashing)
+            else:
+                file_hash = self.manifest.hash_stream(stream)
+                if self.manifest.has_file(file_hash):
+                    print(f"⏭️ Skipping {filename}: already ingested")
+                    return {
+                        'processed': 0,
+                        'dirty_data': 0,
+                        'cleaned_but_duplicate': 0,
+                        'cleaning_errors': 0,
+                        'skipped_rows': 0,
+                        'skipped_file': True,
+                        'table_name': table_name,
+                        'message': f'{filename} was already ingested'
+                    }
+            
+            job = self.dirty_sink.job()
+            profile = self.profiler.profile(filename)
+            result = self.ingest_stream(stream, filename, table_name, job, profile)
+            result['error_summary'] = job.close()
+            if 'error' not in result:
+                result['profile'] = self.profiler.persist(profile)
+            
+            complete = 'error' not in result and not result.get('errors') and not result.get('incomplete')
+            if hashing is not None and complete:
+                file_hash = hashing.hexdigest()
+                if self.manifest.has_file(file_hash):
+                    # Its rows were all skipped by the row-level filter
+                    print(f"⏭️ {filename} was already ingested")
+            
+            if file_hash and complete:
+                rows = result['processed'] + result['dirty_data'] + result.get('skipped_rows', 0)
+                self.manifest.record_file(file_hash, filename, result.get('table_name'), rows)
+            
+            return result
+            
+        except Exception as e:
+            print(f"❌ Error uploading file: {e}")
+            return {'error': str(e)}
+    
+    def ingest_stream(self, stream, filename='', table_name=None, job=None, profile=None):
+        """Decompress a stream (or unpack a zip) and process each table file in it"""
+        try:
+            magic, stream = self.reader.sniff(stream)
+            compression = self.reader.detect_compression(magic, filename)
+            
+            if compression != 'zip':
+                table_stream = self.reader.decompress(stream, compression)
+                return self.process_table_stream(table_stream, filename, table_name, job, profile)
+            
+            with self.reader.open_archive(stream) as archive:
+                members = self.reader.list_members(archive)
+                if not members:
+                    return {'error': 'Archive contains no table files'}
+                
+                print(f"📦 Processing {len(members)} files from {filename}")
+                
+                def process_member(member):
+                    # Members run in parallel, so each fills its own profile
+                    member_profile = self.profiler.profile(member) if profile is not None else None
+                    try:
+                        with archive.open(member) as member_stream:
+                            table_stream = self.reader.open_table(member_stream, member)
+                            result = self.process_table_stream(table_stream, member, table_name, job, member_profile)
+                    except Exception as e:
+                        # One unreadable member (e.g. a nested archive) fails only itself
+                        print(f"❌ Error processing {member}: {e}")
+                        result = {'error': str(e), 'file': member}
+                    return result, member_profile
+                
+                stages = {}
+                for member in members:
+                    member_table = table_name
+                    if not member_table or member_table == 'auto':
+                        member_table = self.detect_member_table(archive, member)
+                    stage = TABLE_LOAD_ORDER.get(TABLE_ALIASES.get(member_table, member_table), len(TABLE_LOAD_ORDER))
+                    stages.setdefault(stage, []).append(member)
+                
+                outcomes = []
+                for stage in sorted(stages):
+                    stage_members = stages[stage]
+                    workers = max(1, min(UPLOAD_MAX_WORKERS, len(stage_members)))
+                    with ThreadPoolExecutor(max_workers=workers) as executor:
+                        outcomes.extend(executor.map(process_member, stage_members))
+            
+            results = [result for result, _ in outcomes]
+            if profile is not None:
+                for _, member_profile in outcomes:
+                    profile.merge(member_profile)
+            
+            return self.combine_results(results)
+            
+        except Exception as e:
+            print(f"❌ Error uploading file: {e}")
+            return {'error': str(e)}
+    
+    def detect_member_table(self, archive, member):
+        """Table type of an archive member from its header alone, or 'unknown'"""
+        try:
+            with archive.open(member) as member_stream:
+                table_stream = self.reader.open_table(member_stream, member)
+                magic, table_stream = self.reader.sniff(table_stream)
+                file_format = self.reader.detect_format(magic, member)
+                if file_format == 'csv':
+                    columns = pd.read_csv(table_stream, nrows=0).columns
+                else:
+                    columns = self.reader.open_columnar(table_stream, file_format).names
+            return self.detect_table_type_from_columns(columns)
+        except Exception as e:
+            print(f"⚠️ Could not detect the table type of {member}: {e}")
+            return 'unknown'
+    
+    def process_table_stream(self, stream, filename='', table_name=None, job=None, profile=None):
+        """Route a decompressed stream to the CSV or columnar reader"""
+        magic, stream = self.reader.sniff(stream)
+        file_format = self.reader.detect_format(magic, filename)
+        
+        if file_format == 'csv':
+            return self.process_csv_stream(stream, filename, table_name, job, profile)
+        return self.process_columnar_stream(stream, file_format, filename, table_name, job, profile)
+    
+    def process_columnar_stream(self, stream, file_format, filename='', table_name=None, job=None, profile=None):
+        """Process a Parquet/Arrow stream, reading only the mapped columns in batches"""
         try:
-            # Read CSV file
-            df = pd.read_csv(file_path)
-            print(f"📊 Loaded {len(df)} records from {file_path}")
+            table = self.reader.open_columnar(stream, file_format)
             
-            # Auto-detect table type if not specified
+            # Auto-detect table type from the schema without reading any data
             if not table_name or table_name == 'auto':
-                table_name = self.detect_table_type(file_path)
-                print(f"🔍 Auto-detected table type: {table_name}")
+                table_name = self.detect_table_type_from_columns(table.names)
+                print(f"🔍 Auto-detected table type for {filename}: {table_name}")
+            
+            if table_name == 'unknown':
+                return {'error': 'Could not determine table type from file schema', 'file': filename}
+            if self.get_table_processor(table_name) is None:
+                return {'error': f'Unsupported table type: {table_name}', 'file': filename}
+            
+            columns = self.cleaner.get_source_columns(TABLE_ALIASES.get(table_name, table_name), table.names)
+            print(f"📐 Reading {len(columns)} of {len(table.names)} columns from {filename}")
+            
+            results = []
+            total_rows = 0
+            date_orders = {}  # Day/month order of ambiguous date layouts in this file
+            for batch in table.iter_batches(columns):
+                total_rows += len(batch)
+                results.append(self.process_dataframe(batch, table_name, job, profile, date_orders))
+            
+            print(f"📊 Loaded {total_rows} records from {filename}")
+            
+            if not results:
+                return {'error': f'No records found in {filename}', 'file': filename}
             
+            combined = self.combine_results(results)
+            combined['file'] = filename
+            return combined
+            
+        except Exception as e:
+            print(f"❌ Error processing {filename}: {e}")
+            return {'error': str(e), 'file': filename}
+    
+    def process_csv_stream(self, stream, filename='', table_name=None, job=None, profile=None):
+        """Parse a CSV stream in chunks and process each chunk as it arrives"""
+        try:
+            results = []
+            total_rows = 0
+            date_orders = {}  # Day/month order of ambiguous date layouts in this file
+            
+            for chunk in self.reader.read_chunks(stream):
+                # Auto-detect table type from the first chunk's header
+                if not table_name or table_name == 'auto':
+                    table_name = self.detect_table_type_from_columns(chunk.columns)
+                    print(f"🔍 Auto-detected table type for {filename}: {table_name}")
+                
+                total_rows += len(chunk)
+                result = self.process_dataframe(chunk, table_name, job, profile, date_orders)
+                if 'error' in result:
+                    result['file'] = filename
+                    return result
+                results.append(result)
+            
+            print(f"📊 Loaded {total_rows} records from {filename}")
+            
+            if not results:
+                return {'error': f'No records found in {filename}', 'file': filename}
+            
+            combined = self.combine_results(results)
+            combined['file'] = filename
+            return combined
+            
+        except Exception as e:
+            print(f"❌ Error processing {filename}: {e}")
+            return {'error': str(e), 'file': filename}
+    
+    def combine_results(self, results):
+        """Sum per-chunk or per-file results into a single upload result"""
+        errors = [r for r in results if 'error' in r]
+        succeeded = [r for r in results if 'error' not in r]
+        
+        if len(results) == 1:
+            return results[0]
+        if not succeeded:
+            return {'error': 'No files could be processed', 'errors': errors}
+        
+        combined = {
+            'processed': sum(r['processed'] for r in succeeded),
+            'dirty_data': sum(r['dirty_data'] for r in succeeded),
+            'cleaned_but_duplicate': sum(r['cleaned_but_duplicate'] for r in succeeded),
+            'cleaning_errors': sum(r['cleaning_errors'] for r in succeeded),
+            'skipped_rows': sum(r.get('skipped_rows', 0) for r in succeeded),
+            'retry_rows': sum(r.get('retry_rows', 0) for r in succeeded),
+            'incomplete': any(r.get('incomplete') for r in succeeded),
+        }
+        
+        table_names = sorted(set(r['table_name'] for r in succeeded))
+        combined['table_name'] = table_names[0] if len(table_names) == 1 else table_names
+        
+        # Multi-file uploads report each file separately
+        if len(set(r.get('file') for r in results)) > 1:
+            combined['files'] = results
+        if errors:
+            combined['errors'] = errors
+        
+        summaries = [r['error_summary'] for r in results if 'error_summary' in r]
+        if summaries:
+            combined['error_summary'] = DirtyDataSink.merge_summaries(summaries)
+        
+        profiles = [r['profile'] for r in results if 'profile' in r]
+        if profiles:
+            combined['profiles'] = profiles
+        
+        combined['message'] = f"Successfully processed {combined['processed']} records, {combined['dirty_data']} moved to dirty table"
+        return combined
+    
+    def process_dataframe(self, df, table_name, job=None, profile=None, date_orders=None):
+        """Clean and insert a DataFrame with proper duplicate handling"""
+        try:
             if table_name == 'unknown':
                 return {'error': 'Could not determine table type from CSV columns'}
             
             # Process the data based on table type
-            if table_name == 'airlines':
-                cleaned_df, dirty_data = self.cleaner.process_airlines_data(df)
-                table_to_insert = 'airlines'
-                key_column = 'airlinekey'
-            elif table_name == 'airports':
-                cleaned_df, dirty_data = self.cleaner.process_airports_data(df)
-                table_to_insert = 'airports'
-                key_column = 'airportkey'
-            elif table_name == 'flights':
-                cleaned_df, dirty_data = self.cleaner.process_flights_data(df)
-                table_to_insert = 'flights'
-                key_column = 'flightkey'
-            elif table_name == 'passengers':
-                cleaned_df, dirty_data = self.cleaner.process_passengers_data(df)
-                table_to_insert = 'passengers'
-                key_column = 'passengerkey'
-            elif table_name == 'travel_agency_sales_001':
-                cleaned_df, dirty_data = self.cleaner.process_sales_data(df)
-                table_to_insert = 'factairlinesales'
-                key_column = 'transactionid'
-            else:
+            processor = self.get_table_processor(table_name)
+            if processor is None:
                 return {'error': f'Unsupported table type: {table_name}'}
             
+            process, table_to_insert, key_column = processor
+            
+            manifest_table = TABLE_ALIASES.get(table_name, table_name)
+            
+            # Profile the raw chunk in the same pass that cleans it
+            if profile is not None:
+                profile.update(manifest_table, self.cleaner.map_columns(df, manifest_table))
+            
+            # Only rows not seen in an earlier load are cleaned and inserted
+            total_rows = len(df)
+            df, row_hashes = self.manifest.filter_new_rows(manifest_table, df)
+            skipped_rows = total_rows - len(df)
+            if skipped_rows:
+                print(f"⏭️ Skipped {skipped_rows} already ingested records")
+            
+            # Cleaned rows keep their position in df, which lines up with row_hashes
+            df = df.reset_index(drop=True)
+            if df.empty:
+                cleaned_df, dirty_data = pd.DataFrame(), []
+            elif table_to_insert == 'factairlinesales':
+                cleaned_df, dirty_data = process(df, date_orders)
+            else:
+                cleaned_df, dirty_data = process(df)
+            
             print(f"✅ Cleaned data: {len(cleaned_df)} records, Dirty data: {len(dirty_data)} records")
             
             # Insert cleaned data with duplicate handling
-            successful_inserts = 0
+            inserted_records = []
             duplicate_errors = []
+            retry_positions = set()
             
             if not cleaned_df.empty:
-                # Convert DataFrame to list of dictionaries
-                cleaned_data = cleaned_df.to_dict('records')
+                # Facts reference dimdate, so any new dates are added first
+                if table_to_insert == 'factairlinesales':
+                    self.date_dimension.ensure_dates(cleaned_df['datekey'].unique())
                 
                 # Insert each record individually to catch duplicates
-                for record in cleaned_data:
-                    try:
-                        response = self.supabase.table(table_to_insert).insert(record).execute()
-                        if response.data:
-                            successful_inserts += 1
-                    except Exception as e:
-                        error_str = str(e)
-                        # Check if it's a duplicate key error
-                        if '23505' in error_str or 'duplicate' in error_str.lower():
-                            duplicate_errors.append({
-                                'table_name': table_to_insert,
-                                'original_data': record,
-                                'error_reason': f'Duplicate key: {error_str}'
-                            })
-                        else:
-                            # Other errors also go to dirty data
-                            duplicate_errors.append({
-                                'table_name': table_to_insert,
-                                'original_data': record,
-                                'error_reason': error_str
-                            })
+                for position, record in zip(cleaned_df.index, cleaned_df.to_dict('records')):
+                    status, error = self.cleaner.insert_record(table_to_insert, record)
+                    if status == 'inserted':
+                        inserted_records.append(record)
+                    elif status == 'retry':
+                        # Not the row's fault: left out of dirty_data and the manifest so it is loaded again
+                        print(f"⚠️ Insert failed, row left for the next upload: {error}")
+                        retry_positions.add(position)
+                    elif error is not None:
+                        duplicate_errors.append(self.cleaner.insert_error_record(table_to_insert, record, error))
                 
-                print(f"📥 Successfully inserted: {successful_inserts} records")
+                print(f"📥 Successfully inserted: {len(inserted_records)} records")
                 print(f"🚫 Duplicates/errors: {len(duplicate_errors)} records")
             
+            successful_inserts = len(inserted_records)
+            
+            # Only newly inserted sales change the summary totals
+            if table_to_insert == 'factairlinesales':
+                self.sales_aggregates.apply(inserted_records)
+            
+            # Later chunks are matched only against passengers that were stored
+            if table_to_insert == 'passengers':
+                self.cleaner.passenger_resolver.confirm(inserted_records)
+            
             # Combine all dirty data (cleaning errors + duplicate errors)
             all_dirty_data = dirty_data + duplicate_errors
             
-            # Insert dirty data
-            if all_dirty_data:
-                try:
-                    self.supabase.table('dirty_data').insert(all_dirty_data).execute()
-                    print(f"🗑️ Stored {len(all_dirty_data)} dirty records")
-                except Exception as e:
-                    print(f"❌ Error storing dirty data: {e}")
+            # Dirty rows go through the shared sink in bounded batches; rows
+            # it cannot store in Supabase are kept in local_data instead
+            if job is None:
+                chunk_job = self.dirty_sink.job()
+                chunk_job.add(all_dirty_data)
+                chunk_job.close()
+            else:
+                job.add(all_dirty_data)
+            
+            # Every row that reached a table or dirty_data is remembered; rows
+            # whose insert failed transiently are retried on the next upload
+            self.manifest.record_rows(manifest_table, [
+                row_hash for position, row_hash in enumerate(row_hashes)
+                if position not in retry_positions
+            ])
+            incomplete = bool(retry_positions)
             
             return {
                 'processed': successful_inserts,
                 'dirty_data': len(all_dirty_data),
                 'cleaned_but_duplicate': len(duplicate_errors),
                 'cleaning_errors': len(dirty_data),
+                'skipped_rows': skipped_rows,
+                'retry_rows': len(retry_positions),
+                'incomplete': incomplete,
                 'table_name': table_to_insert,
                 'message': f'Successfully processed {successful_inserts} records, {len(all_dirty_data)} moved to dirty table'
             }
             
         except Exception as e:
-            print(f"❌ Error uploading file: {e}")
+            print(f"❌ Error processing data: {e}")
             return {'error': str(e)}
     
+    def get_sales_analytics(self, **filters):
+        """Sales totals from the incrementally maintained summary table"""
+        return self.sales_aggregates.query(**filters)
+    
     def check_insurance_eligibility(self, passenger_name=None, flight_id=None):
         """Check if customer is eligible for insurance"""
         try:
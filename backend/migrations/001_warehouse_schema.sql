@@ -0,0 +1,159 @@
+-- Tables and functions the loaders need on top of the warehouse tables
+-- (airlines, airports, flights, passengers, factairlinesales, dirty_data).
+-- Run once in the Supabase SQL editor before starting the backend; every
+-- statement can be re-run while no loader is running. /ready lists any
+-- object still missing.
+
+-- dimdate: calendar dimension referenced by factairlinesales (date_dimension.py)
+create table if not exists dimdate (
+    datekey int primary key,
+    fulldate date not null,
+    year int not null,
+    quarter int not null,
+    month int not null,
+    monthname text not null,
+    day int not null,
+    dayofweek int not null,
+    dayname text not null,
+    weekofyear int not null,
+    isweekend boolean not null
+);
+
+-- id_sequences and lease_id_block: shared surrogate id sequences (id_allocator.py)
+create table if not exists id_sequences (
+    name text primary key,
+    next_value bigint not null
+);
+
+drop function if exists lease_id_block(text, int, bigint);
+
+create or replace function lease_id_block(seq_name text, block_size int, start_value bigint, min_value bigint default 0)
+returns bigint language plpgsql as $$
+declare
+    used_value bigint;
+    first_value bigint;
+begin
+    if seq_name = 'passenger' then
+        select max(substring(passengerkey from 2)::bigint) into used_value
+        from passengers where passengerkey ~ '^P[0-9]+$';
+    elsif seq_name = 'transaction' then
+        select max(transactionid) into used_value from factairlinesales;
+    end if;
+
+    insert into id_sequences as s (name, next_value)
+    values (seq_name, greatest(start_value, min_value, coalesce(used_value + 1, start_value)) + block_size)
+    on conflict (name) do update
+        set next_value = greatest(s.next_value, min_value, coalesce(used_value + 1, 0)) + block_size
+    returning next_value - block_size into first_value;
+
+    return first_value;
+end;
+$$;
+
+-- passenger_key_map: duplicate -> canonical passengerkey (passenger_resolver.py)
+create table if not exists passenger_key_map (
+    passengerkey text primary key,
+    canonical_passengerkey text not null,
+    score real
+);
+
+-- sales_summary and its functions: incremental /analytics totals (sales_aggregates.py)
+create table if not exists sales_summary (
+    datekey int not null,
+    flightkey text not null,
+    airlinekey text,
+    originairportkey text,
+    destinationairportkey text,
+    transactions bigint not null default 0,
+    ticketprice numeric not null default 0,
+    taxes numeric not null default 0,
+    baggagefees numeric not null default 0,
+    totalamount numeric not null default 0,
+    primary key (datekey, flightkey)
+);
+
+create or replace function apply_sales_deltas(deltas jsonb)
+returns void language sql as $$
+    insert into sales_summary as s
+    select * from jsonb_populate_recordset(null::sales_summary, deltas)
+    on conflict (datekey, flightkey) do update set
+        airlinekey = coalesce(s.airlinekey, excluded.airlinekey),
+        originairportkey = coalesce(s.originairportkey, excluded.originairportkey),
+        destinationairportkey = coalesce(s.destinationairportkey, excluded.destinationairportkey),
+        transactions = s.transactions + excluded.transactions,
+        ticketprice = s.ticketprice + excluded.ticketprice,
+        taxes = s.taxes + excluded.taxes,
+        baggagefees = s.baggagefees + excluded.baggagefees,
+        totalamount = s.totalamount + excluded.totalamount;
+$$;
+
+-- Recompute the summary from factairlinesales. Run once after creating the
+-- table to backfill facts loaded earlier (and again to repair it), while no
+-- loader is running: loaders add their deltas after inserting the facts
+create or replace function rebuild_sales_summary()
+returns void language sql as $$
+    lock table sales_summary in exclusive mode;
+    delete from sales_summary;
+    insert into sales_summary
+    select
+        s.datekey,
+        s.flightkey,
+        substring(s.flightkey from '^[A-Z]+'),
+        f.originairportkey,
+        f.destinationairportkey,
+        count(*),
+        coalesce(sum(s.ticketprice), 0),
+        coalesce(sum(s.taxes), 0),
+        coalesce(sum(s.baggagefees), 0),
+        coalesce(sum(s.totalamount), 0)
+    from factairlinesales s
+    left join flights f on f.flightkey = s.flightkey
+    group by s.datekey, s.flightkey, f.originairportkey, f.destinationairportkey;
+$$;
+
+select rebuild_sales_summary();
+
+-- Filtered, grouped totals for /analytics, returned as one JSON array so the
+-- result is not cut off at PostgREST's row limit
+create or replace function query_sales_summary(
+    group_by text[],
+    flight_key text default null,
+    airline_key text default null,
+    origin text default null,
+    destination text default null,
+    date_from int default null,
+    date_to int default null
+)
+returns jsonb language sql stable as $$
+    select coalesce(jsonb_agg(t order by t.datekey, t.flightkey, t.airlinekey,
+                              t.originairportkey, t.destinationairportkey), '[]'::jsonb)
+    from (
+        select
+            case when 'date' = any(group_by) then s.datekey end as datekey,
+            case when 'flight' = any(group_by) then s.flightkey end as flightkey,
+            case when 'airline' = any(group_by) then s.airlinekey end as airlinekey,
+            case when 'route' = any(group_by) then s.originairportkey end as originairportkey,
+            case when 'route' = any(group_by) then s.destinationairportkey end as destinationairportkey,
+            sum(s.transactions) as transactions,
+            sum(s.ticketprice) as ticketprice,
+            sum(s.taxes) as taxes,
+            sum(s.baggagefees) as baggagefees,
+            sum(s.totalamount) as totalamount
+        from sales_summary s
+        where (flight_key is null or s.flightkey = flight_key)
+          and (airline_key is null or s.airlinekey = airline_key)
+          and (origin is null or s.originairportkey = origin)
+          and (destination is null or s.destinationairportkey = destination)
+          and (date_from is null or s.datekey >= date_from)
+          and (date_to is null or s.datekey <= date_to)
+        group by 1, 2, 3, 4, 5
+    ) t;
+$$;
+
+-- data_quality_profiles: per-upload data profiles (data_profiler.py)
+create table if not exists data_quality_profiles (
+    job_id text primary key,
+    filename text,
+    profiled_at timestamptz not null default now(),
+    profile jsonb not null
+);
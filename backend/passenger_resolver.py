@@ -0,0 +1,327 @@
+import os
+import re
+import threading
+import time
+from difflib import SequenceMatcher
+
+# Blocks larger than this are only compared through the sorted-neighborhood pass
+MAX_BLOCK_SIZE = int(os.getenv('RESOLVER_MAX_BLOCK_SIZE', 50))
+
+# Neighbors each passenger is compared with after sorting by name / email
+WINDOW_SIZE = int(os.getenv('RESOLVER_WINDOW_SIZE', 5))
+
+# Name similarity needed to merge, with and without a matching email
+NAME_THRESHOLD = 0.9
+NAME_THRESHOLD_SAME_EMAIL = 0.7
+
+# Placeholder emails carry no identity information
+GENERIC_EMAIL_LOCALS = {'unknown', 'noemail', 'none', 'na', 'test'}
+
+# Domain DataCleaner.clean_email uses when it builds an email from the name
+PLACEHOLDER_EMAIL_DOMAIN = 'example.com'
+
+# Rows per request when reading or writing passenger_key_map
+KEY_MAP_BATCH_SIZE = 500
+
+# Inserted passengers kept in this process's match index; the index starts
+# over once it reaches this size
+MAX_INDEXED = int(os.getenv('RESOLVER_MAX_INDEXED', 200000))
+
+# Seconds a passengerkey found to have no mapping is trusted before it is looked up again
+KEY_MAP_MISS_TTL = float(os.getenv('RESOLVER_KEY_MAP_MISS_TTL', 300))
+
+# Applied by migrations/001_warehouse_schema.sql; keep the two in sync
+SUPABASE_SQL = '''
+create table if not exists passenger_key_map (
+    passengerkey text primary key,
+    canonical_passengerkey text not null,
+    score real
+);
+'''
+
+
+class PassengerResolver:
+    """Group passenger records that describe the same person
+
+    Only candidate pairs sharing a blocking key (last name + first initial,
+    email local part) or falling in the same sorted-neighborhood window are
+    compared, so the work grows with the number of passengers, not its square.
+
+    New rows are matched against each other and against the passengers this
+    process has inserted (see confirm). That index is per process and bounded
+    by MAX_INDEXED, so fuzzy matching against passengers loaded by another
+    worker or before a restart is not guaranteed; exact key duplicates are
+    still caught by the database. Merges are stored in passenger_key_map,
+    which every process reads back to map sales onto the canonical key.
+    """
+
+    def __init__(self, supabase_client=None):
+        self.supabase = supabase_client
+        self.records = []  # index -> (passengerkey, name, email local part) of inserted passengers
+        self.by_key = {}  # passengerkey -> index
+        self.blocks = {}  # blocking key -> [index]
+        self.key_map = {}  # duplicate passengerkey -> canonical passengerkey
+        self.key_map_misses = {}  # passengerkey -> time it was found unmapped
+        self.lock = threading.Lock()
+
+    def normalize_name(self, full_name):
+        """Lowercase, strip punctuation and collapse whitespace"""
+        return ' '.join(re.sub(r'[^a-z\s]', ' ', str(full_name).lower()).split())
+
+    def email_local(self, email):
+        """Email local part without separators, or '' for placeholder emails"""
+        local, _, domain = str(email or '').lower().partition('@')
+        # first.last@example.com is made up from the name, so it says nothing extra
+        if domain == PLACEHOLDER_EMAIL_DOMAIN:
+            return ''
+        local = re.sub(r'[^a-z0-9]', '', local)
+        return '' if local in GENERIC_EMAIL_LOCALS else local
+
+    def entry(self, row):
+        """(passengerkey, normalized name, email local part) of a cleaned row"""
+        return (row['passengerkey'], self.normalize_name(row.get('fullname', '')),
+                self.email_local(row.get('email')))
+
+    def blocking_keys(self, name, email_local):
+        """Keys under which a passenger is filed for candidate generation"""
+        keys = []
+        tokens = name.split()
+        if tokens:
+            keys.append(f'n:{tokens[-1]}:{tokens[0][0]}')
+        if email_local:
+            keys.append(f'e:{email_local}')
+        return keys
+
+    def score(self, entry_a, entry_b):
+        """Similarity of two passengers, 0 when they should not merge"""
+        _, name_a, email_a = entry_a
+        _, name_b, email_b = entry_b
+
+        # Cheap length check before the full comparison
+        if abs(len(name_a) - len(name_b)) > max(len(name_a), len(name_b)) * 0.3:
+            return 0.0
+
+        same_email = bool(email_a) and email_a == email_b
+        threshold = NAME_THRESHOLD_SAME_EMAIL if same_email else NAME_THRESHOLD
+
+        # quick_ratio is an upper bound on ratio and far cheaper to compute
+        matcher = SequenceMatcher(None, name_a, name_b)
+        if matcher.quick_ratio() < threshold:
+            return 0.0
+        name_score = matcher.ratio()
+
+        if same_email and name_score >= NAME_THRESHOLD_SAME_EMAIL:
+            return name_score
+        if name_score >= NAME_THRESHOLD:
+            # A name alone does not identify a person (two John Smiths without emails)
+            if not email_a and not email_b:
+                return 0.0
+            # Two different real emails point to two different people
+            if email_a and email_b and SequenceMatcher(None, email_a, email_b).ratio() < 0.8:
+                return 0.0
+            return name_score
+        return 0.0
+
+    def same_person(self, entry_a, entry_b):
+        """Whether two rows carrying the same passengerkey describe the same person"""
+        _, name_a, email_a = entry_a
+        _, name_b, email_b = entry_b
+        if email_a and email_b and email_a != email_b:
+            return False
+        return SequenceMatcher(None, name_a, name_b).ratio() >= NAME_THRESHOLD
+
+    def resolve(self, passengers):
+        """Resolve cleaned passenger rows (dicts) against each other and the index
+
+        Returns (canonical, merges, collisions): positions in passengers of
+        the rows to insert; merges mapping each duplicate's passengerkey to
+        the canonical passengerkey of its group; and rows whose passengerkey
+        is already used by a different person. A row repeating a known key
+        for the same person is returned as canonical, leaving the database's
+        duplicate check to decide.
+        """
+        with self.lock:
+            # Batch rows are numbered after the indexed passengers
+            base = len(self.records)
+            entries = [self.entry(row) for row in passengers]
+
+            def lookup(i):
+                return self.records[i] if i < base else entries[i - base]
+
+            canonical = []
+            merges = []
+            collisions = []
+            first_position = {}  # passengerkey -> first position in this batch
+            new_indexes = []
+            batch_blocks = {}
+
+            for position, entry in enumerate(entries):
+                key = entry[0]
+                known = self.by_key.get(key)
+                if known is None and key in first_position:
+                    known = base + first_position[key]
+
+                if known is not None:
+                    if self.same_person(entry, lookup(known)):
+                        canonical.append(position)
+                    else:
+                        collisions.append({
+                            'position': position,
+                            'passengerkey': key,
+                            'existing_name': lookup(known)[1]
+                        })
+                    continue
+
+                if key in self.key_map:
+                    # Merged into another passenger by an earlier load
+                    merges.append({
+                        'position': position,
+                        'passengerkey': key,
+                        'canonical_passengerkey': self.key_map[key],
+                        'score': 1.0
+                    })
+                    continue
+
+                first_position[key] = position
+                new_indexes.append(base + position)
+                for block_key in self.blocking_keys(entry[1], entry[2]):
+                    batch_blocks.setdefault(block_key, []).append(base + position)
+
+            parent = {}
+
+            def find(i):
+                # Indexed passengers are inserted, so they are always canonical
+                while parent.get(i, i) != i:
+                    i = parent[i]
+                return i
+
+            pairs = set()
+            for i in new_indexes:
+                _, name, email = lookup(i)
+                for block_key in self.blocking_keys(name, email):
+                    block = self.blocks.get(block_key, []) + batch_blocks.get(block_key, [])
+                    if len(block) > MAX_BLOCK_SIZE:
+                        continue
+                    pairs.update((min(i, j), max(i, j)) for j in block if j != i)
+
+            # Sorted-neighborhood passes catch typos in the blocking fields
+            for field in (1, 2):
+                ordered = sorted(new_indexes, key=lambda i: lookup(i)[field])
+                for pos, i in enumerate(ordered):
+                    if not lookup(i)[field]:
+                        continue
+                    for j in ordered[pos + 1:pos + 1 + WINDOW_SIZE]:
+                        pairs.add((min(i, j), max(i, j)))
+
+            scores = {}
+            for a, b in sorted(pairs):
+                root_a, root_b = find(a), find(b)
+                if root_a == root_b or (root_a < base and root_b < base):
+                    continue  # Never merge two passengers that are both stored
+                score = self.score(lookup(a), lookup(b))
+                if score:
+                    # The passenger seen first stays canonical
+                    parent[max(root_a, root_b)] = min(root_a, root_b)
+                    scores[max(a, b)] = score
+
+            for i in new_indexes:
+                root = find(i)
+                if root == i:
+                    canonical.append(i - base)
+                else:
+                    merges.append({
+                        'position': i - base,
+                        'passengerkey': lookup(i)[0],
+                        'canonical_passengerkey': lookup(root)[0],
+                        'score': round(scores.get(i, 1.0), 3)
+                    })
+
+            canonical.sort()
+            return canonical, merges, collisions
+
+    def confirm(self, inserted):
+        """Index passengers once their insert has succeeded"""
+        with self.lock:
+            if len(self.records) + len(inserted) > MAX_INDEXED:
+                self.records, self.by_key, self.blocks = [], {}, {}
+            for row in inserted:
+                entry = self.entry(row)
+                if entry[0] in self.by_key:
+                    continue
+                index = len(self.records)
+                self.records.append(entry)
+                self.by_key[entry[0]] = index
+                for block_key in self.blocking_keys(entry[1], entry[2]):
+                    self.blocks.setdefault(block_key, []).append(index)
+
+    def store_merges(self, merges):
+        """Save duplicate -> canonical passengerkey mappings to passenger_key_map"""
+        mappings = [
+            {key: merge[key] for key in ('passengerkey', 'canonical_passengerkey', 'score')}
+            for merge in merges if merge['passengerkey'] != merge['canonical_passengerkey']
+        ]
+        with self.lock:
+            for mapping in mappings:
+                self.key_map[mapping['passengerkey']] = mapping['canonical_passengerkey']
+
+        if self.supabase is None:
+            return
+        for i in range(0, len(mappings), KEY_MAP_BATCH_SIZE):
+            try:
+                self.supabase.table('passenger_key_map').upsert(mappings[i:i + KEY_MAP_BATCH_SIZE]).execute()
+            except Exception as e:
+                print(f"Error storing passenger key mappings: {e}")
+
+    def preload_key_map(self):
+        """Cache every stored duplicate -> canonical mapping"""
+        start = 0
+        while True:
+            response = self.supabase.table('passenger_key_map')\
+                .select('passengerkey, canonical_passengerkey')\
+                .range(start, start + KEY_MAP_BATCH_SIZE - 1)\
+                .execute()
+            with self.lock:
+                for mapping in response.data:
+                    self.key_map[mapping['passengerkey']] = mapping['canonical_passengerkey']
+            if len(response.data) < KEY_MAP_BATCH_SIZE:
+                break
+            start += KEY_MAP_BATCH_SIZE
+        print(f"🔗 Cached {len(self.key_map)} passenger key mappings")
+
+    def lookup_keys(self, passenger_keys):
+        """Fetch stored mappings for keys this process has not resolved or looked up recently"""
+        if self.supabase is None:
+            return
+        now = time.time()
+        with self.lock:
+            missing = [
+                key for key in set(passenger_keys)
+                if key and key not in self.key_map and key not in self.by_key
+                and now - self.key_map_misses.get(key, 0) > KEY_MAP_MISS_TTL
+            ]
+        for i in range(0, len(missing), KEY_MAP_BATCH_SIZE):
+            batch = missing[i:i + KEY_MAP_BATCH_SIZE]
+            try:
+                response = self.supabase.table('passenger_key_map')\
+                    .select('passengerkey, canonical_passengerkey')\
+                    .in_('passengerkey', batch)\
+                    .execute()
+            except Exception as e:
+                print(f"Error looking up passenger key mappings: {e}")
+                continue
+            with self.lock:
+                for key in batch:
+                    self.key_map_misses[key] = now
+                for mapping in response.data:
+                    self.key_map[mapping['passengerkey']] = mapping['canonical_passengerkey']
+                    self.key_map_misses.pop(mapping['passengerkey'], None)
+
+    def canonical_key(self, passenger_key):
+        """Canonical passengerkey from the stored duplicate -> canonical mappings"""
+        with self.lock:
+            # A canonical key can itself be merged later, so follow the chain
+            seen = set()
+            while passenger_key in self.key_map and passenger_key not in seen:
+                seen.add(passenger_key)
+                passenger_key = self.key_map[passenger_key]
+            return passenger_key
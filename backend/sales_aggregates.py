@@ -0,0 +1,239 @@
+import re
+import threading
+import pandas as pd
+
+MEASURES = ['ticketprice', 'taxes', 'baggagefees', 'totalamount']
+
+# Dimensions /analytics can group by, and the summary columns behind them
+DIMENSIONS = {
+    'date': ['datekey'],
+    'flight': ['flightkey'],
+    'airline': ['airlinekey'],
+    'route': ['originairportkey', 'destinationairportkey']
+}
+
+# Rows fetched per request when caching flight routes
+PAGE_SIZE = 1000
+
+# Applied by migrations/001_warehouse_schema.sql. sales_summary holds one row per
+# (datekey, flightkey); deltas are added atomically so loaders can run in parallel
+SUPABASE_SQL = '''
+create table if not exists sales_summary (
+    datekey int not null,
+    flightkey text not null,
+    airlinekey text,
+    originairportkey text,
+    destinationairportkey text,
+    transactions bigint not null default 0,
+    ticketprice numeric not null default 0,
+    taxes numeric not null default 0,
+    baggagefees numeric not null default 0,
+    totalamount numeric not null default 0,
+    primary key (datekey, flightkey)
+);
+
+create or replace function apply_sales_deltas(deltas jsonb)
+returns void language sql as $$
+    insert into sales_summary as s
+    select * from jsonb_populate_recordset(null::sales_summary, deltas)
+    on conflict (datekey, flightkey) do update set
+        airlinekey = coalesce(s.airlinekey, excluded.airlinekey),
+        originairportkey = coalesce(s.originairportkey, excluded.originairportkey),
+        destinationairportkey = coalesce(s.destinationairportkey, excluded.destinationairportkey),
+        transactions = s.transactions + excluded.transactions,
+        ticketprice = s.ticketprice + excluded.ticketprice,
+        taxes = s.taxes + excluded.taxes,
+        baggagefees = s.baggagefees + excluded.baggagefees,
+        totalamount = s.totalamount + excluded.totalamount;
+$$;
+
+-- Recompute the summary from factairlinesales. Run once after creating the
+-- table to backfill facts loaded earlier (and again to repair it), while no
+-- loader is running: loaders add their deltas after inserting the facts
+create or replace function rebuild_sales_summary()
+returns void language sql as $$
+    lock table sales_summary in exclusive mode;
+    delete from sales_summary;
+    insert into sales_summary
+    select
+        s.datekey,
+        s.flightkey,
+        substring(s.flightkey from '^[A-Z]+'),
+        f.originairportkey,
+        f.destinationairportkey,
+        count(*),
+        coalesce(sum(s.ticketprice), 0),
+        coalesce(sum(s.taxes), 0),
+        coalesce(sum(s.baggagefees), 0),
+        coalesce(sum(s.totalamount), 0)
+    from factairlinesales s
+    left join flights f on f.flightkey = s.flightkey
+    group by s.datekey, s.flightkey, f.originairportkey, f.destinationairportkey;
+$$;
+
+select rebuild_sales_summary();
+
+-- Filtered, grouped totals for /analytics, returned as one JSON array so the
+-- result is not cut off at PostgREST's row limit
+create or replace function query_sales_summary(
+    group_by text[],
+    flight_key text default null,
+    airline_key text default null,
+    origin text default null,
+    destination text default null,
+    date_from int default null,
+    date_to int default null
+)
+returns jsonb language sql stable as $$
+    select coalesce(jsonb_agg(t order by t.datekey, t.flightkey, t.airlinekey,
+                              t.originairportkey, t.destinationairportkey), '[]'::jsonb)
+    from (
+        select
+            case when 'date' = any(group_by) then s.datekey end as datekey,
+            case when 'flight' = any(group_by) then s.flightkey end as flightkey,
+            case when 'airline' = any(group_by) then s.airlinekey end as airlinekey,
+            case when 'route' = any(group_by) then s.originairportkey end as originairportkey,
+            case when 'route' = any(group_by) then s.destinationairportkey end as destinationairportkey,
+            sum(s.transactions) as transactions,
+            sum(s.ticketprice) as ticketprice,
+            sum(s.taxes) as taxes,
+            sum(s.baggagefees) as baggagefees,
+            sum(s.totalamount) as totalamount
+        from sales_summary s
+        where (flight_key is null or s.flightkey = flight_key)
+          and (airline_key is null or s.airlinekey = airline_key)
+          and (origin is null or s.originairportkey = origin)
+          and (destination is null or s.destinationairportkey = destination)
+          and (date_from is null or s.datekey >= date_from)
+          and (date_to is null or s.datekey <= date_to)
+        group by 1, 2, 3, 4, 5
+    ) t;
+$$;
+'''
+
+
+class SalesAggregator:
+    """Keep revenue, tax and baggage-fee totals up to date from each loaded batch"""
+
+    def __init__(self, supabase_client):
+        self.supabase = supabase_client
+        self.routes = {}  # flightkey -> (origin, destination)
+        self.pending = {}  # (datekey, flightkey) -> delta not yet stored
+        self.lock = threading.Lock()
+
+    def airline_key(self, flight_key):
+        """Airline code is the letter prefix of the flight key"""
+        match = re.match(r'[A-Z]+', str(flight_key))
+        return match.group(0) if match else None
+
+    def preload_routes(self):
+        """Cache every flight's route up front"""
+        start = 0
+        while True:
+            response = self.supabase.table('flights')\
+                .select('flightkey, originairportkey, destinationairportkey')\
+                .range(start, start + PAGE_SIZE - 1)\
+                .execute()
+            for flight in response.data:
+                self.routes[flight['flightkey']] = (
+                    flight['originairportkey'], flight['destinationairportkey']
+                )
+            if len(response.data) < PAGE_SIZE:
+                break
+            start += PAGE_SIZE
+        print(f"🗺️ Cached routes for {len(self.routes)} flights")
+
+    def lookup_routes(self, flight_keys):
+        """Origin/destination per flight, cached after the first lookup"""
+        missing = [key for key in flight_keys if key not in self.routes]
+        if missing:
+            try:
+                response = self.supabase.table('flights')\
+                    .select('flightkey, originairportkey, destinationairportkey')\
+                    .in_('flightkey', missing)\
+                    .execute()
+                for flight in response.data:
+                    self.routes[flight['flightkey']] = (
+                        flight['originairportkey'], flight['destinationairportkey']
+                    )
+            except Exception as e:
+                print(f"Error looking up flight routes: {e}")
+
+        return {key: self.routes.get(key, (None, None)) for key in flight_keys}
+
+    def compute_deltas(self, records):
+        """Group inserted fact rows into per (datekey, flightkey) deltas"""
+        df = pd.DataFrame(records)
+        df['datekey'] = df['datekey'].astype(int)
+        df['transactions'] = 1
+
+        grouped = df.groupby(['datekey', 'flightkey'], as_index=False)[['transactions'] + MEASURES].sum()
+        routes = self.lookup_routes(grouped['flightkey'].unique().tolist())
+
+        deltas = {}
+        for row in grouped.to_dict('records'):
+            origin, destination = routes[row['flightkey']]
+            deltas[(row['datekey'], row['flightkey'])] = {
+                'datekey': int(row['datekey']),
+                'flightkey': row['flightkey'],
+                'airlinekey': self.airline_key(row['flightkey']),
+                'originairportkey': origin,
+                'destinationairportkey': destination,
+                'transactions': int(row['transactions']),
+                **{measure: float(row[measure]) for measure in MEASURES}
+            }
+        return deltas
+
+    def apply(self, records):
+        """Add a batch of newly inserted factairlinesales rows to the summary"""
+        if not records:
+            return
+
+        deltas = self.compute_deltas(records)
+
+        with self.lock:
+            # Merge into anything a previous failed write left behind
+            for key, delta in deltas.items():
+                if key in self.pending:
+                    pending = self.pending[key]
+                    pending['transactions'] += delta['transactions']
+                    for measure in MEASURES:
+                        pending[measure] += delta[measure]
+                else:
+                    self.pending[key] = delta
+
+            try:
+                self.supabase.rpc('apply_sales_deltas', {'deltas': list(self.pending.values())}).execute()
+                print(f"📈 Updated {len(self.pending)} sales summary rows")
+                self.pending = {}
+            except Exception as e:
+                print(f"❌ Error updating sales summary, will retry with the next batch: {e}")
+
+    def query(self, group_by=None, flight_key=None, airline_key=None, origin=None,
+              destination=None, date_from=None, date_to=None):
+        """Totals from the summary table, filtered and grouped by the given dimensions"""
+        group_by = group_by or ['date']
+        unknown = [dim for dim in group_by if dim not in DIMENSIONS]
+        if unknown:
+            raise ValueError(f"Unknown groupBy: {', '.join(unknown)}")
+
+        # Filtering and grouping run in the database; only the totals come back
+        response = self.supabase.rpc('query_sales_summary', {
+            'group_by': group_by,
+            'flight_key': flight_key,
+            'airline_key': airline_key,
+            'origin': origin,
+            'destination': destination,
+            'date_from': int(date_from) if date_from else None,
+            'date_to': int(date_to) if date_to else None
+        }).execute()
+
+        columns = [col for dim in group_by for col in DIMENSIONS[dim]]
+        return [
+            {
+                **{col: row[col] for col in columns},
+                'transactions': int(row['transactions']),
+                **{measure: float(row[measure]) for measure in MEASURES}
+            }
+            for row in response.data or []
+        ]
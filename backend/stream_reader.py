@@ -0,0 +1,212 @@
+import gzip
+import io
+import os
+import tempfile
+import zipfile
+import pandas as pd
+
+try:
+    import zstandard
+except ImportError:  # zstd uploads are optional
+    zstandard = None
+
+try:
+    import pyarrow as pa
+    import pyarrow.ipc as ipc
+    import pyarrow.parquet as pq
+except ImportError:  # Parquet/Arrow uploads are optional
+    pq = None
+
+GZIP_MAGIC = b'\x1f\x8b'
+ZSTD_MAGIC = b'\x28\xb5\x2f\xfd'
+ZIP_MAGIC = b'PK\x03\x04'
+PARQUET_MAGIC = b'PAR1'
+ARROW_FILE_MAGIC = b'ARRO'  # First bytes of 'ARROW1', also Feather v2
+FEATHER_V1_MAGIC = b'FEA1'
+ARROW_STREAM_MAGIC = b'\xff\xff\xff\xff'
+
+PARQUET_EXTENSIONS = ('.parquet', '.pq')
+ARROW_FILE_EXTENSIONS = ('.arrow', '.feather', '.ipc')
+ARROW_STREAM_EXTENSIONS = ('.arrows',)
+
+# Rows handed to the cleaner at a time
+UPLOAD_CHUNK_SIZE = int(os.getenv('UPLOAD_CHUNK_SIZE', 50000))
+
+# Zip, Parquet and Arrow files above this size are spooled to disk instead of memory
+SPOOL_MAX_SIZE = 64 * 1024 * 1024
+
+
+class _PrefixedStream(io.RawIOBase):
+    """Replay bytes already read for sniffing before continuing with the stream"""
+
+    def __init__(self, prefix, stream):
+        self.prefix = prefix
+        self.stream = stream
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        if self.prefix:
+            size = min(len(buffer), len(self.prefix))
+            buffer[:size] = self.prefix[:size]
+            self.prefix = self.prefix[size:]
+            return size
+
+        data = self.stream.read(len(buffer))
+        if not data:
+            return 0
+        buffer[:len(data)] = data
+        return len(data)
+
+
+class StreamReader:
+    """Open plain, compressed or zipped uploads as table streams without a temp copy"""
+
+    def __init__(self, chunksize=UPLOAD_CHUNK_SIZE):
+        self.chunksize = chunksize
+
+    def sniff(self, stream):
+        """Return (magic bytes, stream positioned at the start of the data)"""
+        if stream.seekable():
+            start = stream.tell()
+            magic = stream.read(4)
+            stream.seek(start)
+            return magic, stream
+
+        magic = stream.read(4)
+        return magic, io.BufferedReader(_PrefixedStream(magic, stream))
+
+    def detect_compression(self, magic, filename=''):
+        """Detect compression from magic bytes, falling back to the file extension"""
+        name = (filename or '').lower()
+
+        if magic.startswith(ZIP_MAGIC) or name.endswith('.zip'):
+            return 'zip'
+        elif magic.startswith(GZIP_MAGIC) or name.endswith('.gz'):
+            return 'gzip'
+        elif magic.startswith(ZSTD_MAGIC) or name.endswith('.zst'):
+            return 'zstd'
+        else:
+            return None
+
+    def decompress(self, stream, compression):
+        """Wrap a stream with a streaming decompressor"""
+        if compression == 'gzip':
+            return gzip.GzipFile(fileobj=stream, mode='rb')
+        elif compression == 'zstd':
+            if zstandard is None:
+                raise ValueError('zstd upload requires the zstandard package')
+            return zstandard.ZstdDecompressor().stream_reader(stream)
+        return stream
+
+    def make_seekable(self, stream):
+        """Spool a non-seekable stream so formats with a trailing footer can be read"""
+        if stream.seekable():
+            return stream
+
+        spooled = tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_SIZE)
+        while True:
+            block = stream.read(1024 * 1024)
+            if not block:
+                break
+            spooled.write(block)
+        spooled.seek(0)
+        return spooled
+
+    def open_archive(self, stream):
+        """Open a zip archive, spooling it first if the stream cannot seek"""
+        # The zip central directory lives at the end of the file, so the
+        # archive has to be seekable before any member can be read
+        return zipfile.ZipFile(self.make_seekable(stream))
+
+    def list_members(self, archive):
+        """List the table files held in a zip archive"""
+        members = []
+        for info in archive.infolist():
+            if info.is_dir():
+                continue
+            name = info.filename
+            if name.startswith('__MACOSX/') or os.path.basename(name).startswith('.'):
+                continue
+            members.append(name)
+        return members
+
+    def open_table(self, stream, filename=''):
+        """Open a single (possibly compressed) table file as a byte stream"""
+        magic, stream = self.sniff(stream)
+        compression = self.detect_compression(magic, filename)
+
+        if compression == 'zip':
+            raise ValueError(f'Nested archive not supported: {filename}')
+
+        return self.decompress(stream, compression)
+
+    def detect_format(self, magic, filename=''):
+        """Detect the table file format from magic bytes and the file extension"""
+        name = (filename or '').lower()
+
+        if magic.startswith(PARQUET_MAGIC) or name.endswith(PARQUET_EXTENSIONS):
+            return 'parquet'
+        elif magic.startswith(ARROW_FILE_MAGIC) or magic.startswith(FEATHER_V1_MAGIC) or name.endswith(ARROW_FILE_EXTENSIONS):
+            return 'arrow'
+        elif magic.startswith(ARROW_STREAM_MAGIC) or name.endswith(ARROW_STREAM_EXTENSIONS):
+            return 'arrow_stream'
+        else:
+            return 'csv'
+
+    def read_chunks(self, stream):
+        """Parse a CSV byte stream into DataFrame chunks"""
+        return pd.read_csv(stream, chunksize=self.chunksize)
+
+    def open_columnar(self, stream, file_format):
+        """Open a Parquet or Arrow stream, reading only its schema"""
+        if pq is None:
+            raise ValueError(f'{file_format} upload requires the pyarrow package')
+
+        if file_format == 'arrow_stream':
+            return ColumnarTable(ipc.open_stream(stream), file_format, self.chunksize)
+
+        # Parquet and Arrow files keep their metadata in a footer
+        stream = self.make_seekable(stream)
+        magic = stream.read(4)
+        stream.seek(0)
+
+        if file_format == 'parquet':
+            return ColumnarTable(pq.ParquetFile(stream), file_format, self.chunksize)
+        elif magic.startswith(FEATHER_V1_MAGIC):
+            raise ValueError('Feather v1 files are not supported, re-save them as Feather v2')
+        else:
+            return ColumnarTable(ipc.open_file(stream), file_format, self.chunksize)
+
+
+class ColumnarTable:
+    """Schema and projected batch access for Parquet, Arrow and Feather files"""
+
+    def __init__(self, source, file_format, batch_size=UPLOAD_CHUNK_SIZE):
+        self.source = source
+        self.file_format = file_format
+        self.batch_size = batch_size
+
+    @property
+    def names(self):
+        """Column names, read from the file metadata only"""
+        if self.file_format == 'parquet':
+            return self.source.schema_arrow.names
+        else:
+            return self.source.schema.names
+
+    def iter_batches(self, columns):
+        """Yield DataFrames holding only the requested columns"""
+        if self.file_format == 'parquet':
+            # Parquet reads only the projected column chunks, row group by row group
+            batches = self.source.iter_batches(batch_size=self.batch_size, columns=columns)
+        elif self.file_format == 'arrow':
+            batches = (self.source.get_batch(i) for i in range(self.source.num_record_batches))
+        else:
+            batches = iter(self.source)
+
+        for batch in batches:
+            if self.file_format != 'parquet':
+                batch = pa.Table.from_batches([batch]).select(columns)
+            yield batch.to_pandas()
@@ -1,42 +1,144 @@
 import React, { useState } from 'react';
 import axios from 'axios';
 
+const API_URL = 'http://localhost:5000';
+const CHUNK_SIZE = 8 * 1024 * 1024;
+const PARALLEL_CHUNKS = 4;
+const CHUNK_RETRIES = 3;
+
+// Remember upload ids so a dropped connection can resume the same upload
+const uploadKey = (file, tableName) => `upload:${file.name}:${file.size}:${file.lastModified}:${tableName}`;
+
+const sleep = (ms) => new Promise((resolve) => setTimeout(resolve, ms));
+
 const FileUpload = () => {
     const [selectedFile, setSelectedFile] = useState(null);
     const [tableName, setTableName] = useState('airlines');
     const [uploadStatus, setUploadStatus] = useState('');
+    const [progress, setProgress] = useState(0);
 
     const handleFileSelect = (event) => {
         setSelectedFile(event.target.files[0]);
     };
 
+    const startOrResumeUpload = async (file) => {
+        const key = uploadKey(file, tableName);
+        const savedId = localStorage.getItem(key);
+
+        if (savedId) {
+            try {
+                const status = await axios.get(`${API_URL}/upload/${savedId}/status`);
+                return { uploadId: savedId, missing: status.data.missingChunks };
+            } catch (error) {
+                localStorage.removeItem(key);
+            }
+        }
+
+        const response = await axios.post(`${API_URL}/upload/init`, {
+            filename: file.name,
+            totalSize: file.size,
+            chunkSize: CHUNK_SIZE,
+            tableName,
+        });
+        localStorage.setItem(key, response.data.uploadId);
+
+        const missing = Array.from({ length: response.data.totalChunks }, (_, i) => i);
+        return { uploadId: response.data.uploadId, missing };
+    };
+
+    const uploadChunk = async (file, uploadId, index, onProgress) => {
+        const start = index * CHUNK_SIZE;
+        const blob = file.slice(start, Math.min(start + CHUNK_SIZE, file.size));
+
+        for (let attempt = 1; ; attempt++) {
+            try {
+                await axios.put(`${API_URL}/upload/${uploadId}/chunk/${index}`, blob, {
+                    headers: { 'Content-Type': 'application/octet-stream' },
+                    onUploadProgress: (event) => onProgress(event.loaded),
+                });
+                onProgress(blob.size);
+                return;
+            } catch (error) {
+                onProgress(0);
+                if (attempt >= CHUNK_RETRIES) {
+                    throw error;
+                }
+                await sleep(1000 * 2 ** attempt);
+            }
+        }
+    };
+
     const handleUpload = async () => {
         if (!selectedFile) {
             alert('Please select a file first');
             return;
         }
 
-        const formData = new FormData();
-        formData.append('file', selectedFile);
-        formData.append('tableName', tableName);
-
         try {
             setUploadStatus('Uploading...');
-            const response = await axios.post('http://localhost:5000/upload', formData, {
-                headers: {
-                    'Content-Type': 'multipart/form-data',
-                },
-            });
+            setProgress(0);
+
+            const file = selectedFile;
+            const { uploadId, missing } = await startOrResumeUpload(file);
+
+            // Bytes already on the server count towards progress
+            const totalChunks = Math.ceil(file.size / CHUNK_SIZE);
+            const pending = new Set(missing);
+            let doneBytes = 0;
+            for (let i = 0; i < totalChunks; i++) {
+                if (!pending.has(i)) {
+                    doneBytes += Math.min(CHUNK_SIZE, file.size - i * CHUNK_SIZE);
+                }
+            }
+
+            const inFlight = {};
+            const reportProgress = () => {
+                const sending = Object.values(inFlight).reduce((sum, bytes) => sum + bytes, 0);
+                setProgress(Math.round(((doneBytes + sending) / file.size) * 100));
+            };
+            reportProgress();
+
+            // Send chunks in order so the server can ingest the prefix early
+            const queue = [...missing].sort((a, b) => a - b);
+            const worker = async () => {
+                while (queue.length > 0) {
+                    const index = queue.shift();
+                    await uploadChunk(file, uploadId, index, (bytes) => {
+                        inFlight[index] = bytes;
+                        reportProgress();
+                    });
+                    delete inFlight[index];
+                    doneBytes += Math.min(CHUNK_SIZE, file.size - index * CHUNK_SIZE);
+                    reportProgress();
+                }
+            };
+            await Promise.all(Array.from({ length: PARALLEL_CHUNKS }, worker));
+
+            setUploadStatus('Finalizing...');
+            let response = await axios.post(`${API_URL}/upload/${uploadId}/finalize`);
+            if (response.status === 202) {
+                // Still ingesting: poll status, then fetch the result once it is complete
+                let status = response.data;
+                while (!status.complete) {
+                    setUploadStatus(`Processing... ${Math.round((status.bytesIngested / file.size) * 100)}% ingested`);
+                    await sleep(2000);
+                    status = (await axios.get(`${API_URL}/upload/${uploadId}/status`)).data;
+                }
+                response = await axios.post(`${API_URL}/upload/${uploadId}/finalize`);
+            }
+
+            localStorage.removeItem(uploadKey(file, tableName));
             setUploadStatus(`Upload successful! Processed ${response.data.processed} records`);
         } catch (error) {
-            setUploadStatus('Upload failed: ' + error.message);
+            const message = error.response?.data?.error || error.message;
+            setUploadStatus('Upload failed: ' + message + ' (upload again to resume)');
         }
     };
 
     const handleProcess = async () => {
         try {
             setUploadStatus('Processing data...');
-            const response = await axios.post('http://localhost:5000/process');
+            const response = await axios.post(`${API_URL}/process`);
             setUploadStatus(`Processing completed! ${response.data.message}`);
         } catch (error) {
             setUploadStatus('Processing failed: ' + error.message);
@@ -67,6 +169,11 @@ const FileUpload = () => {
                     Process Data
                 </button>
             </div>
+            {progress > 0 && progress < 100 && (
+                <div style={{ marginTop: '10px' }}>
+                    <progress value={progress} max="100" /> {progress}%
+                </div>
+            )}
             {uploadStatus && (
                 <div style={{ marginTop: '10px', padding: '10px', backgroundColor: '#f0f0f0' }}>
                     {uploadStatus}